@@ -1,10 +1,20 @@
 import os
+import time
 
 from flask import Flask
 
-from clustermgr.extensions import db, csrf, migrate, wlogger
+from clustermgr.extensions import db, csrf, migrate, wlogger, metrics
+from clustermgr.core import msgcon
 
 from clustermgr.tasks.cluster import *
+from clustermgr.tasks.monitoring import *
+from clustermgr.tasks.monitoring import record_task_duration
+
+
+TASKS = metrics.counter('clustermgr_celery_tasks_total',
+                        'Celery tasks run, by task and final state')
+TASK_DURATION = metrics.histogram('clustermgr_celery_task_duration_seconds',
+                                  'Run time of the celery tasks')
 
 
 def init_celery(app, celery):
@@ -15,8 +25,26 @@ def init_celery(app, celery):
         abstract = True
 
         def __call__(self, *args, **kwargs):
-            with app.app_context():
-                return TaskBase.__call__(self, *args, **kwargs)
+            taskid = self.request.id
+            if taskid:
+                wlogger.start_buffering(taskid)
+            state = 'FAILURE'
+            start = time.time()
+            try:
+                with app.app_context():
+                    retval = TaskBase.__call__(self, *args, **kwargs)
+                state = 'SUCCESS'
+                return retval
+            finally:
+                if taskid:
+                    wlogger.stop_buffering(taskid)
+                    wlogger.finish(taskid, state)
+                elapsed = time.time() - start
+                name = self.name.rsplit('.', 1)[-1]
+                TASKS.inc(task=name, state=state)
+                TASK_DURATION.observe(elapsed, task=name)
+                metrics.flush()
+                record_task_duration(self.name, elapsed)
     celery.Task = ContextTask
 
 
@@ -44,6 +72,8 @@ def create_app():
     migrate.init_app(app, db, directory=os.path.join(os.path.dirname(__file__),
                                                      "migrations"))
     wlogger.init_app(app)
+    metrics.init_app(app)
+    msgcon.init_app(app)
 
     # setup the instance's working directories
     if not os.path.isdir(app.config['SCHEMA_DIR']):
@@ -61,8 +91,10 @@ def create_app():
     from clustermgr.views.index import index
     from clustermgr.views.cluster import cluster
     from clustermgr.views.logserver import logserver
+    from clustermgr.views.metrics import metrics as metrics_view
     app.register_blueprint(index, url_prefix="")
     app.register_blueprint(cluster, url_prefix="/cluster")
     app.register_blueprint(logserver, url_prefix="/logging_server")
+    app.register_blueprint(metrics_view, url_prefix="")
 
     return app
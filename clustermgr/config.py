@@ -14,14 +14,73 @@ class Config(object):
     REDIS_HOST = 'localhost'
     REDIS_PORT = 6379
     REDIS_LOG_DB = 0
+    # messages of a task are sent to redis in batches of this size, or after
+    # this many seconds
+    WEBLOGGER_BUFFER_SIZE = 50
+    WEBLOGGER_FLUSH_INTERVAL = 0.5
+    # the log of a task expires a day after its last message and keeps only
+    # its latest messages within these limits
+    WEBLOGGER_TTL = 86400
+    WEBLOGGER_MAX_ENTRIES = 5000
+    WEBLOGGER_MAX_BYTES = 5 * 1024 * 1024
+    # stream the task logs to the browser with Server-Sent Events instead of
+    # polling them. Each stream holds a worker until its task ends, so only
+    # enable it with threaded or gevent workers
+    LOG_STREAMING = False
+    # seconds during which each process aggregates its metrics before adding
+    # them to redis
+    METRICS_FLUSH_INTERVAL = 5
+    # (connect, read) timeouts in seconds of the requests to the logging
+    # server, and seconds its responses are cached: the newest page of logs
+    # changes, the older pages and the log items don't
+    LOGSERVER_TIMEOUT = (5, 30)
+    LOGSERVER_CACHE_TTL = 15
+    LOGSERVER_PAGE_CACHE_TTL = 600
     OX11_PORT = '8190'
     SCHEDULE_REFRESH = 30.0
+    # seconds between two replication lag checks
+    REPLICATION_LAG_INTERVAL = 60.0
+    # seconds between two health probes of the servers, the timeout of the
+    # probe connections and the number of probes kept per server
+    HEALTH_CHECK_INTERVAL = 60.0
+    HEALTH_CHECK_TIMEOUT = 5
+    HEALTH_HISTORY = 20
+    # seconds between two reads of the cn=monitor backend of the servers
+    MONITOR_INTERVAL = 60.0
+    # seconds between two additions of the queued samples to the history of
+    # the metrics
+    SERIES_FLUSH_INTERVAL = 60.0
+    # concurrency of the operations run against many servers at once
+    FANOUT_MAX_WORKERS = 16
+    FANOUT_PER_HOST = 1
+    # seconds the replication test waits for a change to reach a consumer
+    REPLICATION_TEST_TIMEOUT = 30
     CELERYBEAT_SCHEDULE = {
         'add-every-30-seconds': {
             'task': 'clustermgr.tasks.schedule_key_rotation',
             'schedule': timedelta(seconds=SCHEDULE_REFRESH),
             'args': (),
         },
+        'replication-lag': {
+            'task': 'clustermgr.tasks.monitoring.check_replication_lag',
+            'schedule': timedelta(seconds=REPLICATION_LAG_INTERVAL),
+            'args': (),
+        },
+        'server-health': {
+            'task': 'clustermgr.tasks.monitoring.check_server_health',
+            'schedule': timedelta(seconds=HEALTH_CHECK_INTERVAL),
+            'args': (),
+        },
+        'monitor-metrics': {
+            'task': 'clustermgr.tasks.monitoring.collect_monitor_metrics',
+            'schedule': timedelta(seconds=MONITOR_INTERVAL),
+            'args': (),
+        },
+        'metric-series': {
+            'task': 'clustermgr.tasks.monitoring.flush_metric_series',
+            'schedule': timedelta(seconds=SERIES_FLUSH_INTERVAL),
+            'args': (),
+        },
     }
     DATA_DIR = os.environ.get(
         "DATA_DIR",
@@ -0,0 +1,195 @@
+"""Helpers to run the same operation against many servers concurrently.
+"""
+import time
+import threading
+from collections import namedtuple
+from Queue import Queue, Empty
+
+from clustermgr.core.remote import pool as remote_pool
+
+
+#: Outcome of a step run against a single host. ``value`` is the return value
+#: of the step and ``error`` the exception raised by it, if any.
+HostResult = namedtuple('HostResult',
+                        ['host', 'ok', 'value', 'error', 'elapsed'])
+
+
+def parallel_map(func, items, max_workers=16):
+    """Calls ``func`` with every item using a bounded number of threads.
+
+    Args:
+        func (callable): function taking a single item
+        items (list): the items to process
+        max_workers (int, optional): maximum number of concurrent calls
+
+    Returns:
+        list of (value, error, elapsed) tuples in the order of the items,
+        where error is the exception raised by the call or None
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            start = time.time()
+            try:
+                results[index] = (func(item), None, time.time() - start)
+            except Exception as e:
+                results[index] = (None, e, time.time() - start)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_workers, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class FanOut(object):
+    """Runs a step against a set of servers concurrently over SSH.
+
+    A step is any callable taking a connected
+    :class:`clustermgr.core.remote.RemoteClient`. The clients are borrowed
+    from the process wide connection pool. The number of steps running at the
+    same time is bounded both globally and per host.
+
+    Args:
+        max_workers (int, optional): maximum number of concurrent steps
+        per_host (int, optional): maximum number of concurrent steps against
+            the same host
+        log (callable, optional): function called with ``(message, level,
+            **kwargs)`` to report the progress, e.g. a ``functools.partial``
+            of ``wlogger.log`` with the task id. The messages are tagged with
+            the hostname.
+        user (string, optional): the SSH user. Defaults to root
+
+    Example::
+
+        fan = FanOut(log=partial(wlogger.log, tid))
+        results = fan.run(LDAPServer.query.all(),
+                          command('service solserver restart'))
+    """
+
+    def __init__(self, max_workers=16, per_host=1, log=None, user='root'):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.log = log
+        self.user = user
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _log(self, host, message, level='info', **kwargs):
+        if self.log:
+            self.log("[{0}] {1}".format(host, message), level, host=host,
+                     **kwargs)
+
+    def _limit(self, host):
+        with self._lock:
+            if host not in self._limits:
+                self._limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._limits[host]
+
+    def _connect(self, server):
+        hostname = server.hostname
+        try:
+            return remote_pool.get(hostname, self.user)
+        except Exception:
+            ip = getattr(server, 'ip', None)
+            if not ip:
+                raise
+            self._log(hostname, "Retrying with the IP address", 'warning')
+            return remote_pool.get(ip, self.user)
+
+    def _run_job(self, job):
+        server, step = job
+        host = server.hostname
+        limit = self._limit(host)
+        with limit:
+            start = time.time()
+            try:
+                client = self._connect(server)
+                try:
+                    value = step(client)
+                except Exception:
+                    # the connection may be in an unknown state, it is not
+                    # given back to the pool
+                    client.close()
+                    raise
+                remote_pool.put(client)
+            except Exception as e:
+                elapsed = time.time() - start
+                self._log(host, "Failed after {0:.2f}s: {1}".format(
+                    elapsed, e), 'error', elapsed=elapsed)
+                return HostResult(host, False, None, e, elapsed)
+            elapsed = time.time() - start
+            self._log(host, "Done in {0:.2f}s".format(elapsed), 'success',
+                      elapsed=elapsed)
+            return HostResult(host, True, value, None, elapsed)
+
+    def run_jobs(self, jobs):
+        """Runs a list of ``(server, step)`` jobs concurrently.
+
+        Returns:
+            list of :obj:`HostResult` in the order of the jobs
+        """
+        results = parallel_map(self._run_job, jobs, self.max_workers)
+        return [value for value, _, _ in results]
+
+    def run(self, servers, step):
+        """Runs the same step against every server.
+
+        Args:
+            servers (list): :class:`clustermgr.models.LDAPServer` or
+                :class:`clustermgr.models.OxauthServer` objects
+            step (callable): the step to run
+
+        Returns:
+            list of :obj:`HostResult` in the order of the servers
+        """
+        start = time.time()
+        results = self.run_jobs([(server, step) for server in servers])
+        if self.log and results:
+            failed = len([r for r in results if not r.ok])
+            self.log("Finished on {0} host(s) in {1:.2f}s, {2} failed".format(
+                len(results), time.time() - start, failed),
+                'error' if failed else 'info')
+        return results
+
+
+def command(cmd):
+    """Step running a command. Its value is the (stdin, stdout, stderr) tuple
+    returned by RemoteClient.run().
+    """
+    def step(client):
+        return client.run(cmd)
+    return step
+
+
+def upload(local, remote):
+    """Step uploading a file. Raises IOError with the message returned by
+    RemoteClient.upload() when the upload fails.
+    """
+    def step(client):
+        out = client.upload(local, remote)
+        if 'Error' in out:
+            raise IOError(out)
+        return out
+    return step
+
+
+def probe(paths):
+    """Step probing remote paths. Its value is the map returned by
+    RemoteClient.exists_many().
+    """
+    def step(client):
+        return client.exists_many(paths)
+    return step
@@ -1,17 +1,259 @@
+import calendar
+import time
+import threading
 from contextlib import contextmanager
 
 import ldap
+from ldap.controls import SimplePagedResultsControl
+
+from clustermgr.metrics import metrics
+
+LDAP_OPERATION = metrics.histogram(
+    'clustermgr_ldap_operation_seconds',
+    'Time spent waiting for the LDAP servers, by operation')
+
+
+class SchemeCache(object):
+    """Remembers the scheme (``ldap``, ``starttls`` or ``ldaps``) that worked
+    last for a server, so the next connection starts with it instead of
+    waiting for the ``ldap`` attempt to fail first.
+
+    Args:
+        ttl (int, optional): seconds for which a scheme is remembered.
+            Defaults to 3600
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._schemes = {}
+        self._lock = threading.Lock()
+
+    def get(self, hostname, port):
+        with self._lock:
+            scheme, expires = self._schemes.get((hostname, int(port)),
+                                                (None, 0))
+        if expires < time.time():
+            return None
+        return scheme
+
+    def set(self, hostname, port, scheme):
+        with self._lock:
+            self._schemes[(hostname, int(port))] = (scheme,
+                                                    time.time() + self.ttl)
+
+    def forget(self, hostname, port):
+        with self._lock:
+            self._schemes.pop((hostname, int(port)), None)
+
+
+#: The schemes negotiated by the current process
+schemes = SchemeCache()
+
+
+def _connect(hostname, port, user, passwd, starttls=False):
+    """Initializes and binds a new connection. The ``ldap`` scheme (or
+    ``starttls`` when requested) is tried first and ``ldaps`` is used when
+    the server can't be reached with it. The scheme which worked is
+    remembered and tried first the next time.
+    """
+    candidates = ['starttls' if starttls else 'ldap', 'ldaps']
+    cached = schemes.get(hostname, port)
+    if cached in candidates:
+        candidates.remove(cached)
+        candidates.insert(0, cached)
+
+    for scheme in candidates:
+        uri = '{0}://{1}:{2}'.format(
+            'ldaps' if scheme == 'ldaps' else 'ldap', hostname, port)
+        try:
+            with LDAP_OPERATION.time(operation='connect', scheme=scheme):
+                conn = ldap.initialize(uri)
+                if scheme == 'starttls':
+                    conn.start_tls_s()
+                conn.bind_s(user, passwd)
+        except ldap.SERVER_DOWN:
+            if scheme == cached:
+                schemes.forget(hostname, port)
+            if scheme == candidates[-1]:
+                raise
+            continue
+        schemes.set(hostname, port, scheme)
+        return conn
+
+
+class LDAPConnectionPool(object):
+    """A pool of bound LDAP connections keyed by the host, port, bind DN and
+    protocol. A connection is used by one caller at a time and is given back
+    to the pool after use, so the subsequent callers skip the TCP and TLS
+    handshakes and the bind.
+
+    Args:
+        max_size (int, optional): maximum number of idle connections kept per
+            key. Defaults to 4
+        idle_timeout (int, optional): seconds after which an idle connection
+            is unbound. Defaults to 300
+        check_after (int, optional): connections idle for longer than this
+            number of seconds are checked with a whoami request before being
+            reused. Defaults to 10
+    """
+
+    def __init__(self, max_size=4, idle_timeout=300, check_after=10):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(hostname, port, user, starttls):
+        return (hostname, int(port), user, 'starttls' if starttls else 'ldap')
+
+    @staticmethod
+    def _unbind(conn):
+        try:
+            conn.unbind()
+        except ldap.LDAPError:
+            pass
+
+    def _alive(self, conn):
+        try:
+            conn.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+    def _evict(self, now):
+        """Removes the expired idle connections. Must be called with the lock
+        held.
+        """
+        expired = []
+        for key, entries in self._idle.items():
+            fresh = [e for e in entries if now - e[2] <= self.idle_timeout]
+            expired.extend(e[0] for e in entries
+                           if now - e[2] > self.idle_timeout)
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+        return expired
+
+    def get(self, hostname, port, user, passwd, starttls=False):
+        """Returns a bound connection, reusing an idle one if possible. A
+        connection that fails the liveness check is replaced by a new one,
+        which makes the pool rebind transparently after the server went down.
+        """
+        return self.checkout(hostname, port, user, passwd, starttls)[0]
+
+    def checkout(self, hostname, port, user, passwd, starttls=False):
+        """Same as get() but also tells whether the connection was reused.
+
+        Returns:
+            tuple of the connection and True if it comes from the pool
+        """
+        key = self._key(hostname, port, user, starttls)
+        now = time.time()
+        conn = None
+        with self._lock:
+            stale = self._evict(now)
+
+        # take the idle connections one at a time, the others stay in the
+        # pool for the concurrent callers while this one is checked
+        while conn is None:
+            with self._lock:
+                entries = self._idle.get(key)
+                if not entries:
+                    break
+                candidate, secret, last_used = entries.pop()
+            if secret != passwd:
+                stale.append(candidate)
+            elif now - last_used < self.check_after or \
+                    self._alive(candidate):
+                conn = candidate
+            else:
+                stale.append(candidate)
+        for c in stale:
+            self._unbind(c)
+
+        if conn is None:
+            return _connect(hostname, port, user, passwd, starttls), False
+        return conn, True
+
+    def put(self, conn, hostname, port, user, passwd, starttls=False):
+        """Gives a connection obtained from get() back to the pool.
+        """
+        key = self._key(hostname, port, user, starttls)
+        with self._lock:
+            entries = self._idle.setdefault(key, [])
+            if len(entries) < self.max_size:
+                entries.append((conn, passwd, time.time()))
+                conn = None
+        if conn is not None:
+            self._unbind(conn)
+
+    def close(self):
+        """Unbinds all the idle connections.
+        """
+        with self._lock:
+            entries = [e for es in self._idle.values() for e in es]
+            self._idle = {}
+        for entry in entries:
+            self._unbind(entry[0])
+
+
+#: The LDAP connection pool of the current process
+pool = LDAPConnectionPool()
+
+
+class PooledConnection(object):
+    """Proxy of a connection borrowed from the pool. When the first operation
+    on a reused connection raises ``SERVER_DOWN``, the connection died while
+    idle in the pool (server restarted, idle timeout) and the request never
+    reached the server, so it is retried once on a new connection.
+
+    Args:
+        conn: the bound connection
+        reused (bool): whether the connection comes from the pool
+        reconnect (callable): returns a new bound connection
+    """
+
+    def __init__(self, conn, reused, reconnect):
+        self.conn = conn
+        self._retry = reused
+        self._reconnect = reconnect
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            retry, self._retry = self._retry, False
+            try:
+                return getattr(self.conn, name)(*args, **kwargs)
+            except ldap.SERVER_DOWN:
+                if not retry:
+                    raise
+            LDAPConnectionPool._unbind(self.conn)
+            self.conn = self._reconnect()
+            return getattr(self.conn, name)(*args, **kwargs)
+        return call
 
 
 @contextmanager
 def ldap_conn(hostname, port, user, passwd, starttls=False):
-    """Establishes connection to LDAP and releases the connection
-    after being used.
+    """Provides a bound LDAP connection from the connection pool and gives it
+    back to the pool after being used.
 
     This function handles 2 different schemes (``ldap`` and ``ldaps``).
     The first-class scheme is ``ldap`` (enabling TLS is recommended).
     If it can't establish the connection, this function will try
-    to use ``ldaps`` scheme. Otherwise, exception will be raised.
+    to use ``ldaps`` scheme. Otherwise, exception will be raised. The scheme
+    which worked is tried first by the next connections to the server.
+
+    A connection on which ``SERVER_DOWN`` is raised is dropped instead of
+    being reused. When it is raised by the first operation on a pooled
+    connection, the operation is retried once on a new connection, refer
+    :class:`PooledConnection`.
 
     Example::
 
@@ -19,30 +261,179 @@ def ldap_conn(hostname, port, user, passwd, starttls=False):
             conn.search_s()
     """
     try:
-        conn = ldap.initialize('ldap://{}:{}'.format(hostname, port))
-        if starttls:
-            conn.start_tls_s()
-        conn.bind_s(user, passwd)
-        yield conn
-    except ldap.SERVER_DOWN:
-        conn = ldap.initialize('ldaps://{}:{}'.format(hostname, port))
-        conn.bind_s(user, passwd)
-        yield conn
+        with LDAP_OPERATION.time(operation='checkout'):
+            conn, reused = pool.checkout(hostname, port, user, passwd,
+                                         starttls)
     except ldap.LDAPError as exc:
         print exc
         raise
-    finally:
-        conn.unbind()
+
+    proxy = PooledConnection(
+        conn, reused,
+        lambda: _connect(hostname, port, user, passwd, starttls))
+    try:
+        yield proxy
+    except ldap.SERVER_DOWN:
+        pool._unbind(proxy.conn)
+        raise
+    except Exception:
+        pool.put(proxy.conn, hostname, port, user, passwd, starttls)
+        raise
+    pool.put(proxy.conn, hostname, port, user, passwd, starttls)
+
+
+def bind_time(hostname, port, user, passwd, starttls=False):
+    """Measures the time taken to open a new connection to the server and
+    bind to it. The connection doesn't go through the pool and is unbound
+    right away.
+
+    Args:
+        hostname (string): hostname of the server
+        port (int): port of the LDAP server
+        user (string): DN to bind as
+        passwd (string): password of the DN
+        starttls (bool, optional): whether to use StartTLS on the ldap scheme
+
+    Returns:
+        the time in seconds to connect and bind
+    """
+    start = time.time()
+    conn = _connect(hostname, port, user, passwd, starttls)
+    elapsed = time.time() - start
+    conn.unbind_s()
+    return elapsed
 
 
 def search_from_ldap(conn, base, scope=ldap.SCOPE_BASE,
                      filterstr="(objectClass=*)",
                      attrlist=None, attrsonly=0):
     """Searches entries in LDAP.
+
+    Returns:
+        the first matching entry as a (dn, attrs) tuple, or ("", {}) when
+        nothing matches. Use :func:`paged_search` to read all the entries.
     """
     try:
-        result = conn.search_s(base, scope)
+        with LDAP_OPERATION.time(operation='search'):
+            result = conn.search_s(base, scope, filterstr, attrlist,
+                                   attrsonly)
         ret = result[0]
-    except ldap.NO_SUCH_OBJECT:
+    except (ldap.NO_SUCH_OBJECT, IndexError):
         ret = ("", {},)
     return ret
+
+
+def paged_search(conn, base, scope=ldap.SCOPE_SUBTREE,
+                 filterstr="(objectClass=*)", attrlist=None, attrsonly=0,
+                 page_size=500):
+    """Searches entries in LDAP using the Simple Paged Results control and
+    yields them as they arrive. Only one page is requested from the server
+    at a time, so any number of entries can be walked with a flat memory
+    usage.
+
+    Example::
+
+        with ldap_conn(hostname, port, user, passwd) as conn:
+            for dn, attrs in paged_search(conn, "o=gluu",
+                                          filterstr="(objectClass=gluuPerson)",
+                                          attrlist=["uid"]):
+                print dn
+
+    Args:
+        conn: a bound LDAP connection
+        base (string): the base DN of the search
+        scope (int, optional): the search scope. Defaults to subtree
+        filterstr (string, optional): the search filter
+        attrlist (list, optional): the attributes to return. All the user
+            attributes are returned by default
+        attrsonly (int, optional): return only the attribute names if 1
+        page_size (int, optional): number of entries requested per page
+
+    Yields:
+        (dn, attrs) tuples
+    """
+    ctrl = SimplePagedResultsControl(True, size=page_size, cookie='')
+    msgid = None
+    try:
+        while True:
+            start = time.time()
+            msgid = conn.search_ext(base, scope, filterstr, attrlist,
+                                    attrsonly, serverctrls=[ctrl])
+            waited = time.time() - start
+            while True:
+                start = time.time()
+                rtype, rdata, _, serverctrls = conn.result3(msgid, all=0)
+                waited += time.time() - start
+                if rtype == ldap.RES_SEARCH_RESULT:
+                    # the time the caller spent on the entries is left out
+                    LDAP_OPERATION.observe(waited, operation='search_page')
+                    break
+                if rtype != ldap.RES_SEARCH_ENTRY:
+                    continue
+                for entry in rdata:
+                    yield entry
+            msgid = None
+
+            cookie = ''
+            for control in serverctrls:
+                if control.controlType == \
+                        SimplePagedResultsControl.controlType:
+                    cookie = control.cookie
+            if not cookie:
+                return
+            ctrl.cookie = cookie
+    finally:
+        # the caller stopped before the last page
+        if msgid is not None:
+            conn.abandon(msgid)
+
+
+def parse_csn(csn):
+    """Parses a Change Sequence Number as found in the ``contextCSN`` and
+    ``entryCSN`` attributes, e.g. ``20170718120000.123456Z#000000#001#000000``
+
+    Args:
+        csn (string): the CSN value
+
+    Returns:
+        tuple of the timestamp of the change in seconds since the epoch
+        (float), the change count (int) and the server ID (string)
+    """
+    stamp, count, sid = csn.split("#")[:3]
+    seconds, _, fraction = stamp.rstrip("Z").partition(".")
+    timestamp = calendar.timegm(time.strptime(seconds, "%Y%m%d%H%M%S"))
+    if fraction:
+        timestamp += float("0." + fraction)
+    return timestamp, int(count, 16), sid
+
+
+def get_context_csn(conn, base):
+    """Reads the ``contextCSN`` values of a suffix.
+
+    Args:
+        conn: a bound LDAP connection
+        base (string): the suffix DN, e.g. o=gluu
+
+    Returns:
+        dict mapping the server ID to the CSN value of that server
+    """
+    dn, attrs = search_from_ldap(conn, base, attrlist=["contextCSN"])
+    csns = {}
+    for csn in attrs.get("contextCSN", []):
+        csns[parse_csn(csn)[2]] = csn
+    return csns
+
+
+def count_entries(conn, base, filterstr, limit=10000):
+    """Counts the entries matching a filter without fetching their
+    attributes. The search is abandoned once ``limit`` entries are seen.
+
+    Returns:
+        the number of matching entries, capped at ``limit``
+    """
+    count = 0
+    for _ in paged_search(conn, base, filterstr=filterstr, attrlist=["1.1"]):
+        count += 1
+        if count >= limit:
+            break
+    return count
@@ -1,7 +1,171 @@
-import requests
-import urlparse
+import threading
+import time
 import urllib
 
+import requests
+from requests.adapters import HTTPAdapter
+
+from clustermgr.metrics import metrics
+
+REQUEST_TIME = metrics.histogram(
+    'clustermgr_logserver_request_seconds',
+    'Time taken by the requests proxied to the logging server')
+CACHE_HITS = metrics.counter(
+    'clustermgr_logserver_cache_hits_total',
+    'Responses of the logging server served from the cache')
+
+#: (connect, read) timeouts in seconds of the requests to the logging
+#: server, set from LOGSERVER_TIMEOUT by init_app()
+TIMEOUT = (5, 30)
+
+#: seconds the newest page of logs is served from the cache, set from
+#: LOGSERVER_CACHE_TTL by init_app()
+CACHE_TTL = 15
+
+#: seconds the pages of older logs and the log items, which don't change,
+#: are served from the cache, set from LOGSERVER_PAGE_CACHE_TTL by init_app()
+PAGE_CACHE_TTL = 600
+
+
+class ResponseCache(object):
+    """Thread safe cache of the responses of the logging server, each entry
+    expiring ttl seconds after it was stored.
+
+    Args:
+        ttl (int): default lifetime of an entry in seconds
+        max_entries (int): the entries closest to expiry are dropped when
+            more are stored
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value stored for the key or None when it is missing or
+        has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Stores a value for ttl seconds, the default ttl of the cache when
+        not given.
+        """
+        with self._lock:
+            now = time.time()
+            if len(self._entries) >= self.max_entries:
+                for k, (expires, _) in self._entries.items():
+                    if expires <= now:
+                        del self._entries[k]
+            if len(self._entries) >= self.max_entries:
+                oldest = min(self._entries,
+                             key=lambda k: self._entries[k][0])
+                del self._entries[oldest]
+            self._entries[key] = (now + (ttl or self.ttl), value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+#: process wide session keeping the connections to the logging server alive
+session = _session()
+
+#: process wide cache of the responses of the logging server
+cache = ResponseCache()
+
+
+def init_app(app):
+    """Reads the timeouts and the lifetimes of the cached responses from the
+    application config.
+    """
+    global TIMEOUT, CACHE_TTL, PAGE_CACHE_TTL
+    TIMEOUT = tuple(app.config.get('LOGSERVER_TIMEOUT', TIMEOUT))
+    CACHE_TTL = app.config.get('LOGSERVER_CACHE_TTL', CACHE_TTL)
+    PAGE_CACHE_TTL = app.config.get('LOGSERVER_PAGE_CACHE_TTL',
+                                    PAGE_CACHE_TTL)
+    cache.ttl = CACHE_TTL
+
+
+#: events set once the fetches in progress in this process are done
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def _get(endpoint, key, url, ttl=None):
+    """Returns the decoded JSON response of the logging server and its
+    status code, from the cache when it was fetched less than ttl seconds
+    ago, CACHE_TTL by default. Only the successful responses are cached.
+
+    A request already in progress for the same key, like a prefetch, is
+    waited for instead of being sent again.
+    """
+    cached = cache.get(key)
+    if cached is not None:
+        CACHE_HITS.inc(endpoint=endpoint)
+        return cached
+
+    with _pending_lock:
+        done = _pending.get(key)
+        owner = done is None
+        if owner:
+            done = _pending[key] = threading.Event()
+    if not owner:
+        done.wait(TIMEOUT[1])
+        cached = cache.get(key)
+        if cached is not None:
+            CACHE_HITS.inc(endpoint=endpoint)
+            return cached
+
+    try:
+        with REQUEST_TIME.time(endpoint=endpoint):
+            req = session.get(url, timeout=TIMEOUT)
+
+        if not req.ok:
+            return {}, req.status_code
+        result = req.json(), req.status_code
+        cache.set(key, result, ttl)
+        return result
+    finally:
+        if owner:
+            with _pending_lock:
+                del _pending[key]
+            done.set()
+
+
+def prefetch(fetch, *args, **kwargs):
+    """Calls one of the get functions in a daemon thread to have its
+    response in the cache when it is requested. The errors are ignored, the
+    request is sent again when the response is needed.
+    """
+    def run():
+        try:
+            fetch(*args, **kwargs)
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
 
 class LogItem(object):
     def __init__(self, data):
@@ -17,95 +181,186 @@ class LogItem(object):
 
 
 class LogCollection(object):
-    def __init__(self, key, data):
+    """A page of logs returned by :func:`get_audit_logs` or
+    :func:`get_server_logs`, newest first.
+
+    The pages are navigated with the id of the oldest log shown (next_cursor)
+    or of the newest one (prev_cursor) instead of a page number, so the
+    logging server seeks to the page in its id index however old it is. The
+    page number is carried along for the servers which only support the
+    ``page`` argument, refer :func:`keyset_supported`.
+
+    Args:
+        key (string): name of the list of logs in the HAL response
+        data (dict): the response of the logging server
+        size (int): the number of logs requested
+        before (int, optional): the id the logs were requested before
+        after (int, optional): the id the logs were requested after, in
+            ascending order
+        number (int, optional): the number of the page, 0 for the newest
+    """
+
+    def __init__(self, key, data, size=20, before=None, after=None,
+                 number=0):
         self.key = key
         self.embedded = data.get("_embedded", {})
         self.links = data.get("_links", {})
         self.page = data.get("page", {})
+        self.size = size
+        self.before = before
+        self.after = after
+        self.number = number
 
     def get_logs(self):
         if not self.has_logs():
             return []
-        return [LogItem(item) for item in self.embedded[self.key]]
+        logs = [LogItem(item) for item in self.embedded[self.key]]
+        if self.after is not None:
+            logs.reverse()
+        return logs
 
     def has_logs(self):
         if self.key not in self.embedded:
             return False
         return len(self.embedded[self.key]) > 0
 
+    def _is_full(self):
+        return len(self.embedded.get(self.key, [])) >= self.size
+
     @property
     def has_next(self):
-        return "next" in self.links
+        if not self.has_logs():
+            return False
+        # the page before ``after`` starts with the ``after`` log itself
+        return self.after is not None or self._is_full()
 
     @property
-    def next_page(self):
+    def next_cursor(self):
+        """The id to request the older logs before.
+        """
         if not self.has_next:
-            return 0
-        return self._get_page(self.links["next"]["href"])
+            return None
+        return self.get_logs()[-1].id
+
+    @property
+    def next_args(self):
+        """Query arguments of the page of older logs.
+        """
+        return {"before": self.next_cursor, "page": self.number + 1,
+                "size": self.size}
 
     @property
     def has_prev(self):
-        return "prev" in self.links
+        if not self.has_logs():
+            return False
+        if self.after is not None:
+            return self._is_full()
+        return self.before is not None or self.number > 0
 
     @property
-    def prev_page(self):
+    def prev_cursor(self):
+        """The id to request the newer logs after.
+        """
         if not self.has_prev:
-            return 0
-        return self._get_page(self.links["prev"]["href"])
+            return None
+        return self.get_logs()[0].id
+
+    @property
+    def prev_args(self):
+        """Query arguments of the page of newer logs.
+        """
+        return {"after": self.prev_cursor, "page": self.number - 1,
+                "size": self.size}
+
+
+#: the logging servers found to ignore the before and after arguments
+_offset_only = set()
 
-    def _get_page(self, url):
-        parsed_url = urlparse.urlparse(url)
-        parsed_qs = urlparse.parse_qs(parsed_url.query)
-        try:
-            page = parsed_qs["page"][0]
-        except (KeyError, IndexError,):
-            page = 0
-        return page
-
-
-def get_audit_logs(base_url, page=0, size=20):
-    qs = urllib.urlencode({
-        "sort": "id,desc",
-        "page": page,
-    })
-    url = "{}/logger/api/oauth2-audit-logs/search/query?{}".format(
-        base_url, qs,
-    )
-    req = requests.get(url)
-
-    if not req.ok:
-        return {}, req.status_code
-    return req.json(), req.status_code
-
-
-def get_server_logs(base_url, page=0, size=20):
-    qs = urllib.urlencode({
-        "sort": "id,desc",
-        "page": page,
-    })
-    url = "{}/logger/api/oxauth-server-logs/search/query?{}".format(
-        base_url, qs,
-    )
-    req = requests.get(url)
-
-    if not req.ok:
-        return {}, req.status_code
-    return req.json(), req.status_code
+
+def keyset_supported(base_url):
+    """Returns False once the logging server has been seen ignoring the
+    before and after arguments. Its logs are then requested by page number.
+    """
+    return base_url not in _offset_only
+
+
+def _ignores_cursor(data, before=None, after=None):
+    """Tells whether a response holds logs on the wrong side of the cursor
+    it was requested with.
+    """
+    ids = [LogItem(item).id
+           for items in data.get("_embedded", {}).values() for item in items]
+    if before is not None:
+        return any(id >= before for id in ids)
+    if after is not None:
+        return any(id <= after for id in ids)
+    return False
+
+
+def _query(before=None, after=None, size=20):
+    params = {"size": size}
+    if after is not None:
+        params["sort"] = "id,asc"
+        params["after"] = after
+    else:
+        params["sort"] = "id,desc"
+        if before is not None:
+            params["before"] = before
+    return urllib.urlencode(params)
+
+
+def _page_ttl(before):
+    # the logs older than a given id don't change, unlike the newest ones
+    return PAGE_CACHE_TTL if before is not None else CACHE_TTL
+
+
+def _get_logs(endpoint, path, base_url, before, after, size, page):
+    """Fetches a page of logs by cursor, or by page number when there is no
+    cursor or the server doesn't support them.
+    """
+    url = "{0}{1}?".format(base_url, path)
+    if (before is not None or after is not None) and \
+            keyset_supported(base_url):
+        data, status_code = _get(
+            endpoint, (base_url, endpoint, before, after, size),
+            url + _query(before, after, size), _page_ttl(before))
+        if not _ignores_cursor(data, before, after):
+            return data, status_code
+        _offset_only.add(base_url)
+
+    qs = urllib.urlencode({"sort": "id,desc", "page": max(page, 0),
+                           "size": size})
+    return _get(endpoint, (base_url, endpoint, max(page, 0), size),
+                url + qs)
+
+
+def get_audit_logs(base_url, before=None, after=None, size=20, page=0):
+    """Fetches the audit logs with an id lower than before, newest first, or
+    the ones with an id greater than after, oldest first. The page number is
+    used instead when the logging server doesn't support the cursors.
+    """
+    return _get_logs("audit_logs",
+                     "/logger/api/oauth2-audit-logs/search/query",
+                     base_url, before, after, size, page)
+
+
+def get_server_logs(base_url, before=None, after=None, size=20, page=0):
+    """Fetches the server logs with an id lower than before, newest first,
+    or the ones with an id greater than after, oldest first. The page number
+    is used instead when the logging server doesn't support the cursors.
+    """
+    return _get_logs("server_logs",
+                     "/logger/api/oxauth-server-logs/search/query",
+                     base_url, before, after, size, page)
 
 
 def get_audit_log_item(base_url, id):
     url = "{}/logger/api/oauth2-audit-logs/{}".format(base_url, id)
-    req = requests.get(url)
-
-    if not req.ok:
-        return {}, req.status_code
-    return req.json(), req.status_code
+    return _get("audit_log_item", (base_url, "audit_log_item", id), url,
+                PAGE_CACHE_TTL)
 
 
 def get_server_log_item(base_url, id):
     url = "{}/logger/api/oxauth-server-logs/{}".format(base_url, id)
-    req = requests.get(url)
-
-    if not req.ok:
-        return {}, req.status_code
-    return req.json(), req.status_code
+    return _get("server_log_item", (base_url, "server_log_item", id), url,
+                PAGE_CACHE_TTL)
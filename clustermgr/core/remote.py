@@ -1,5 +1,16 @@
+import time
+import pipes
+import select
+import hashlib
+import tarfile
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
 from paramiko.client import SSHClient, AutoAddPolicy
 
+from clustermgr.metrics import metrics
+
 
 class ClientNotSetupException(Exception):
     """Exception raised when the client is not initialized because
@@ -7,6 +18,21 @@ class ClientNotSetupException(Exception):
     pass
 
 
+#: Result of a remote path probe. Only ``exists`` is set for missing paths,
+#: the other fields are None in that case. ``mode`` is the raw st_mode.
+PathStat = namedtuple('PathStat', ['exists', 'size', 'mtime', 'mode'])
+
+MISSING_PATH = PathStat(False, None, None, None)
+
+SSH_CONNECT = metrics.histogram(
+    'clustermgr_ssh_connect_seconds',
+    'Time taken to open a SSH connection and its SFTP channel')
+SSH_CONNECT_ERRORS = metrics.counter('clustermgr_ssh_connect_errors_total',
+                                     'SSH connections which failed')
+SSH_COMMAND = metrics.histogram('clustermgr_ssh_command_seconds',
+                                'Run time of the commands run over SSH')
+
+
 class RemoteClient(object):
     """Remote Client is a wrapper over SSHClient with utility functions.
 
@@ -33,12 +59,43 @@ class RemoteClient(object):
         self.client.set_missing_host_key_policy(AutoAddPolicy())
         self.client.load_system_host_keys()
 
-    def startup(self):
+    def startup(self, keepalive=0, timeout=None):
         """Function that starts SSH connection and makes client available for
         carrying out the functions.
+
+        Args:
+            keepalive (int, optional): interval in seconds between keepalive
+                packets sent over the transport. 0 disables them.
+            timeout (int, optional): seconds to wait for the TCP connection
+                and the SSH banner. Defaults to the OS and paramiko defaults
         """
-        self.client.connect(self.host, port=22, username=self.user)
-        self.sftpclient = self.client.open_sftp()
+        try:
+            with SSH_CONNECT.time(host=self.host):
+                self.client.connect(self.host, port=22, username=self.user,
+                                    timeout=timeout, banner_timeout=timeout)
+                if keepalive:
+                    self.client.get_transport().set_keepalive(keepalive)
+                self.sftpclient = self.client.open_sftp()
+        except Exception:
+            SSH_CONNECT_ERRORS.inc(host=self.host)
+            raise
+
+    def is_active(self):
+        """Checks whether the underlying SSH transport is still usable. An
+        ignore packet is sent over the transport so that a connection dropped
+        by the remote side is detected without running a command.
+
+        Returns:
+            True if the connection is alive, False otherwise
+        """
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
 
     def download(self, remote, local):
         """Downloads a file from remote server to the local system.
@@ -46,6 +103,9 @@ class RemoteClient(object):
         Args:
             remote (string): location of the file in remote server
             local (string): path where the file should be saved
+
+        Returns:
+            a message starting with ``Error:`` when the download failed
         """
         if not self.sftpclient:
             raise ClientNotSetupException(
@@ -55,10 +115,9 @@ class RemoteClient(object):
             self.sftpclient.get(remote, local)
         except OSError:
             return "Error: Local file %s doesn't exist." % local
-        except IOError:
-            return "Error: Remote location %s doesn't exist." % remote
-        finally:
-            return "Download successful. File at: {0}".format(local)
+        except IOError as e:
+            return "Error: Could not download %s: %s" % (remote, e)
+        return "Download successful. File at: {0}".format(local)
 
     def upload(self, local, remote):
         """Uploads the file from local location to remote server.
@@ -66,6 +125,10 @@ class RemoteClient(object):
         Args:
             local (string): path of the local file to upload
             remote (string): location on remote server to put the file
+
+        Returns:
+            a message starting with ``Error:`` when the upload failed. The
+            size of the uploaded file is checked against the local one
         """
         if not self.sftpclient:
             raise ClientNotSetupException(
@@ -75,10 +138,9 @@ class RemoteClient(object):
             self.sftpclient.put(local, remote)
         except OSError:
             return "Error: Local file %s doesn't exist." % local
-        except IOError:
-            return "Error: Remote location %s doesn't exist." % remote
-        finally:
-            return "Upload successful. File at: {0}".format(remote)
+        except IOError as e:
+            return "Error: Could not upload to %s: %s" % (remote, e)
+        return "Upload successful. File at: {0}".format(remote)
 
     def exists(self, filepath):
         """Returns whether a file exists or not in the remote server.
@@ -98,6 +160,101 @@ class RemoteClient(object):
         elif len(cerr.read()) > 5:
             return False
 
+    def exists_many(self, paths):
+        """Probes a number of paths in the remote server with a single
+        ``stat`` invocation, so the whole batch costs one round trip.
+
+        Args:
+            paths (list): paths to check in the remote server
+
+        Returns:
+            dict mapping each path to a :obj:`PathStat`
+        """
+        if not self.client:
+            raise ClientNotSetupException(
+                'Cannot run procedure. Client not initialized')
+
+        result = dict((path, MISSING_PATH) for path in paths)
+        if not result:
+            return result
+
+        # %n goes last as it is the only field which can contain spaces
+        command = "stat -c '%s %Y %f %n' -- {0}".format(
+            ' '.join(pipes.quote(path) for path in result))
+        cin, cout, cerr = self.client.exec_command(command)
+        for line in cout.read().splitlines():
+            try:
+                size, mtime, mode, path = line.split(' ', 3)
+                result[path] = PathStat(True, int(size), int(mtime),
+                                        int(mode, 16))
+            except ValueError:
+                continue
+        return result
+
+    def sync_files(self, files, remote_dir):
+        """Uploads a set of files to a remote directory, skipping the files
+        whose remote copy already has the same MD5 digest. The remote digests
+        are gathered with one command and the changed files are sent as a
+        single tar stream, so a sync costs two round trips whatever the
+        number of files.
+
+        Args:
+            files (dict): mapping of the remote file name to the path of the
+                local file
+            remote_dir (string): directory in the remote server where the
+                files are placed. It is created if missing.
+
+        Returns:
+            tuple of the list of uploaded file names and a string containing
+            the error reported by the remote server, empty on success
+        """
+        if not self.client:
+            raise ClientNotSetupException(
+                'Cannot upload files. Client not initialized')
+
+        local_digests = {}
+        for name, local in files.items():
+            md5 = hashlib.md5()
+            with open(local, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    md5.update(chunk)
+            local_digests[name] = md5.hexdigest()
+
+        remote_digests = {}
+        if local_digests:
+            command = 'cd {0} && md5sum -- {1}'.format(
+                pipes.quote(remote_dir),
+                ' '.join(pipes.quote(name) for name in local_digests))
+            cin, cout, cerr = self.client.exec_command(command)
+            for line in cout.read().splitlines():
+                digest, _, name = line.partition('  ')
+                remote_digests[name] = digest
+
+        changed = sorted(name for name, digest in local_digests.items()
+                         if remote_digests.get(name) != digest)
+        if not changed:
+            return [], ''
+
+        command = 'mkdir -p {0} && tar -xf - -C {0}'.format(
+            pipes.quote(remote_dir))
+        cin, cout, cerr = self.client.exec_command(command)
+        archive = tarfile.open(mode='w|', fileobj=cin)
+        for name in changed:
+            info = archive.gettarinfo(files[name], arcname=name)
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            info.mode = 0644
+            with open(files[name], 'rb') as f:
+                archive.addfile(info, f)
+        archive.close()
+        cin.channel.shutdown_write()
+
+        err = cerr.read()
+        if cout.channel.recv_exit_status() != 0:
+            return [], err or 'Error: Failed to extract the files in ' \
+                'remote location {0}'.format(remote_dir)
+        return changed, ''
+
     def run(self, command):
         """Run a command in the remote server.
 
@@ -111,17 +268,256 @@ class RemoteClient(object):
             raise ClientNotSetupException(
                 'Cannot run procedure. Client not initialized')
 
-        buffers = self.client.exec_command(command)
-        output = []
-        for buf in buffers:
-            try:
-                output.append(buf.read())
-            except IOError:
-                output.append('')
+        with SSH_COMMAND.time(host=self.host, mode='run'):
+            buffers = self.client.exec_command(command)
+            output = []
+            for buf in buffers:
+                try:
+                    output.append(buf.read())
+                except IOError:
+                    output.append('')
 
         return tuple(output)
 
+    def stream(self, command, timeout=None, bufsize=4096):
+        """Run a command in the remote server and yield its output line by
+        line as soon as it arrives, instead of waiting for the command to
+        exit. Only the incomplete trailing line of each stream is buffered.
+
+        Args:
+            command (string): the command to be run on the remote server
+            timeout (int, optional): seconds after which the channel is closed
+                even if the command is still running. Useful for commands
+                which run in the foreground like ``slapd -d 1``
+
+        Yields:
+            tuple of the stream name (``stdout`` or ``stderr``) and the line
+            without the trailing newline
+        """
+        if not self.client:
+            raise ClientNotSetupException(
+                'Cannot run procedure. Client not initialized')
+
+        chan = self.client.get_transport().open_session()
+        chan.exec_command(command)
+        readers = (('stdout', chan.recv_ready, chan.recv),
+                   ('stderr', chan.recv_stderr_ready, chan.recv_stderr))
+        partial = {'stdout': '', 'stderr': ''}
+        start = time.time()
+        deadline = start + timeout if timeout else None
+        try:
+            while True:
+                received = False
+                for name, ready, recv in readers:
+                    if not ready():
+                        continue
+                    data = recv(bufsize)
+                    if not data:
+                        continue
+                    received = True
+                    lines = (partial[name] + data).split('\n')
+                    partial[name] = lines.pop()
+                    for line in lines:
+                        yield name, line.rstrip('\r')
+                # checked first, a chatty command never leaves the loop idle
+                if deadline and time.time() > deadline:
+                    break
+                if received:
+                    continue
+                if chan.exit_status_ready() and not chan.recv_ready() \
+                        and not chan.recv_stderr_ready():
+                    break
+                select.select([chan], [], [], 1.0)
+            for name, _, _ in readers:
+                if partial[name]:
+                    yield name, partial[name].rstrip('\r')
+        finally:
+            chan.close()
+            SSH_COMMAND.observe(time.time() - start, host=self.host,
+                                mode='stream')
+
+    def pipe(self, command, chunks):
+        """Run a command in the remote server feeding it data on its stdin.
+        The data is sent as it is produced, so arbitrarily large input can be
+        streamed without staging it in a file first.
+
+        Args:
+            command (string): the command to be run on the remote server
+            chunks (iterable): strings to write to the stdin of the command
+
+        Returns:
+            tuple of the stdout, the stderr and the exit status of the command
+        """
+        if not self.client:
+            raise ClientNotSetupException(
+                'Cannot run procedure. Client not initialized')
+
+        start = time.time()
+        chan = self.client.get_transport().open_session()
+        chan.exec_command(command)
+        out, err = [], []
+
+        def drain():
+            # keep the remote side from blocking on a full window
+            while chan.recv_ready():
+                out.append(chan.recv(32768))
+            while chan.recv_stderr_ready():
+                err.append(chan.recv_stderr(32768))
+
+        try:
+            for chunk in chunks:
+                chan.sendall(chunk)
+                drain()
+            chan.shutdown_write()
+            while not chan.exit_status_ready() or chan.recv_ready() \
+                    or chan.recv_stderr_ready():
+                drain()
+                select.select([chan], [], [], 1.0)
+            drain()
+            return ''.join(out), ''.join(err), chan.recv_exit_status()
+        finally:
+            chan.close()
+            SSH_COMMAND.observe(time.time() - start, host=self.host,
+                                mode='pipe')
+
     def close(self):
         """Close the SSH Connection
         """
         self.client.close()
+
+
+class RemoteClientPool(object):
+    """A pool of connected :class:`RemoteClient` objects keyed by the host and
+    user. Clients returned to the pool are reused by the subsequent borrows
+    for the same host, sparing the SSH handshake and the SFTP subsystem setup.
+
+    Each worker process keeps its own pool, so connections are never shared
+    across forked processes.
+
+    Args:
+        max_idle (int, optional): seconds after which an unused client is
+            closed and removed from the pool. Defaults to 300
+        keepalive (int, optional): interval in seconds for the SSH keepalive
+            packets of the pooled connections. Defaults to 30
+        max_per_host (int, optional): maximum number of idle clients kept per
+            (host, user). Defaults to 4
+
+    Example::
+
+        with pool.borrow('ldap.example.com') as c:
+            c.run('service solserver status')
+    """
+
+    def __init__(self, max_idle=300, keepalive=30, max_per_host=4):
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self.max_per_host = max_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        """Removes the clients that have been idle longer than max_idle.
+        Must be called with the lock held.
+        """
+        expired = []
+        for key, entries in self._idle.items():
+            fresh = []
+            for client, last_used in entries:
+                if now - last_used > self.max_idle:
+                    expired.append(client)
+                else:
+                    fresh.append((client, last_used))
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+        return expired
+
+    def get(self, host, user='root', timeout=None):
+        """Returns a connected client for the host, reusing an idle one when
+        it passes the health check.
+
+        Args:
+            host (string): hostname or IP address of the server
+            user (string, optional): the user to connect as. Defaults to root
+            timeout (int, optional): connection timeout in seconds of a new
+                client, refer :meth:`RemoteClient.startup`
+
+        Returns:
+            a connected :class:`RemoteClient`
+
+        Raises:
+            any exception raised by :meth:`RemoteClient.startup` when a new
+            connection has to be established
+        """
+        key = (host, user)
+        client = None
+        with self._lock:
+            stale = self._evict(time.time())
+            entries = self._idle.get(key, [])
+            while entries and client is None:
+                candidate = entries.pop()[0]
+                if candidate.is_active():
+                    client = candidate
+                else:
+                    stale.append(candidate)
+        for c in stale:
+            c.close()
+
+        if client is None:
+            client = RemoteClient(host, user)
+            client.startup(keepalive=self.keepalive, timeout=timeout)
+        return client
+
+    def put(self, client):
+        """Returns a client back to the pool so that it can be reused.
+
+        Args:
+            client (:class:`RemoteClient`): the client obtained from get()
+        """
+        if not client.is_active():
+            client.close()
+            return
+        key = (client.host, client.user)
+        with self._lock:
+            entries = self._idle.setdefault(key, [])
+            if len(entries) < self.max_per_host:
+                entries.append((client, time.time()))
+                client = None
+        if client is not None:
+            client.close()
+
+    def discard(self, host, user='root'):
+        """Closes all the idle clients of the host.
+        """
+        with self._lock:
+            entries = self._idle.pop((host, user), [])
+        for client, _ in entries:
+            client.close()
+
+    def close(self):
+        """Closes every idle client in the pool.
+        """
+        with self._lock:
+            entries = [e for es in self._idle.values() for e in es]
+            self._idle = {}
+        for client, _ in entries:
+            client.close()
+
+    @contextmanager
+    def borrow(self, host, user='root', timeout=None):
+        """Context manager borrowing a client from the pool. The client is
+        returned to the pool on exit, unless the block raised an exception
+        in which case the connection is closed.
+        """
+        client = self.get(host, user, timeout)
+        try:
+            yield client
+        except Exception:
+            client.close()
+            raise
+        self.put(client)
+
+
+#: The connection pool of the current process
+pool = RemoteClientPool()
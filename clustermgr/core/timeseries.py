@@ -0,0 +1,210 @@
+"""Compact storage of the numeric history of a metric.
+
+A :class:`Series` keeps the latest points of a metric in fixed size rings:
+the raw samples, their one minute means and their one hour means. Once a
+ring is full the oldest point is overwritten, so the size of a series never
+grows. The whole series is serialized into a single binary string to be
+stored in a database column.
+"""
+import struct
+from array import array
+
+
+#: (resolution in seconds, capacity) of the rings of a series. A resolution
+#: of 0 keeps the raw samples. The defaults keep the last 120 samples, 6
+#: hours of one minute means and 30 days of one hour means in about 10 KB,
+#: so 500 series (10 metrics of 50 servers) fit in 5 MB.
+TIERS = ((0, 120), (60, 360), (3600, 720))
+
+# head, size, bucket, count and sum of a ring, stored before its points
+HEADER = struct.Struct('<IIIId')
+
+
+class Ring(object):
+    """Fixed size ring of (timestamp, value) points. The timestamps are
+    stored as unsigned 32 bits integers and the values as 32 bits floats.
+
+    Rings with a resolution average the values added during the same period
+    and store the mean once the period is over.
+
+    Args:
+        capacity (int): maximum number of points kept
+        resolution (int, optional): period in seconds averaged into one
+            point, 0 to store every value. Defaults to 0
+    """
+
+    def __init__(self, capacity, resolution=0):
+        self.capacity = capacity
+        self.resolution = resolution
+        self.timestamps = array('I', [0] * capacity)
+        self.values = array('f', [0.0] * capacity)
+        self.head = 0
+        self.size = 0
+        # period being averaged
+        self.bucket = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def append(self, timestamp, value):
+        """Stores a point, overwriting the oldest one when the ring is full.
+        """
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def add(self, timestamp, value):
+        """Adds a sample, stored as is or averaged with the samples of the
+        same period depending on the resolution.
+        """
+        if not self.resolution:
+            self.append(timestamp, value)
+            return
+        bucket = timestamp - timestamp % self.resolution
+        if self.count and bucket != self.bucket:
+            self.append(self.bucket, self.sum / self.count)
+            self.count = 0
+            self.sum = 0.0
+        self.bucket = bucket
+        self.count += 1
+        self.sum += value
+
+    def points(self):
+        """Returns the points from the oldest to the newest, including the
+        mean of the period being averaged.
+        """
+        start = (self.head - self.size) % self.capacity
+        points = [(self.timestamps[(start + i) % self.capacity],
+                   self.values[(start + i) % self.capacity])
+                  for i in range(self.size)]
+        if self.count:
+            points.append((self.bucket, self.sum / self.count))
+        return points
+
+    def oldest(self):
+        """Returns the timestamp of the oldest point or None when empty.
+        """
+        if self.size:
+            return self.timestamps[(self.head - self.size) % self.capacity]
+        if self.count:
+            return self.bucket
+        return None
+
+    def dumps(self):
+        return HEADER.pack(self.head, self.size, self.bucket, self.count,
+                           self.sum) + \
+            self.timestamps.tostring() + self.values.tostring()
+
+    def loads(self, data):
+        """Restores the ring from the string returned by dumps().
+
+        Returns:
+            the length of data consumed
+        """
+        offset = HEADER.size
+        self.head, self.size, self.bucket, self.count, self.sum = \
+            HEADER.unpack(data[:offset])
+        for points in (self.timestamps, self.values):
+            length = self.capacity * points.itemsize
+            chunk = data[offset:offset + length]
+            if len(chunk) != length:
+                raise ValueError("Truncated series data")
+            points[:] = array(points.typecode, chunk)
+            offset += length
+        return offset
+
+
+class Series(object):
+    """The history of a metric stored in rings of decreasing resolution.
+
+    Args:
+        tiers (tuple, optional): (resolution, capacity) of the rings.
+            Defaults to :data:`TIERS`
+    """
+
+    def __init__(self, tiers=TIERS):
+        self.rings = [Ring(capacity, resolution)
+                      for resolution, capacity in tiers]
+
+    def add(self, timestamp, value):
+        """Adds a sample to every ring.
+
+        Args:
+            timestamp (int): unix time of the sample
+            value (float): the value of the metric
+        """
+        timestamp = int(timestamp)
+        for ring in self.rings:
+            ring.add(timestamp, value)
+
+    def query(self, start, end, max_points=None):
+        """Returns the points between two times from the finest ring going
+        back to the start, or the coarsest one when none does.
+
+        Args:
+            start (int): unix time of the oldest point to return
+            end (int): unix time of the newest point to return
+            max_points (int, optional): the points are averaged into at most
+                this number of evenly spaced buckets
+
+        Returns:
+            tuple of the resolution of the ring used and the list of
+            (timestamp, value) points
+        """
+        ring = self.rings[-1]
+        for candidate in self.rings:
+            oldest = candidate.oldest()
+            if oldest is not None and oldest <= start:
+                ring = candidate
+                break
+        points = [(ts, value) for ts, value in ring.points()
+                  if start <= ts <= end]
+        if max_points and len(points) > max_points:
+            points = downsample(points, start, end, max_points)
+        return ring.resolution, points
+
+    def dumps(self):
+        """Serializes the series into a binary string.
+        """
+        return ''.join(ring.dumps() for ring in self.rings)
+
+    @classmethod
+    def loads(cls, data, tiers=TIERS):
+        """Creates a series from the string returned by dumps(). The data of
+        a series stored with other tiers is discarded.
+        """
+        series = cls(tiers)
+        if not data:
+            return series
+        offset = 0
+        try:
+            for ring in series.rings:
+                offset += ring.loads(data[offset:])
+        except (ValueError, struct.error):
+            return cls(tiers)
+        if offset != len(data):
+            return cls(tiers)
+        return series
+
+
+def downsample(points, start, end, max_points):
+    """Averages sorted points into at most max_points buckets of the same
+    width spanning the start to end range.
+
+    Returns:
+        list of (timestamp, value) points, the timestamp being the mean of
+        the timestamps of the points in the bucket
+    """
+    width = max(float(end - start) / max_points, 1.0)
+    buckets = []
+    current = None
+    for ts, value in points:
+        index = int((ts - start) / width)
+        if current is None or current[0] != index:
+            current = [index, 0, 0.0, 0.0]
+            buckets.append(current)
+        current[1] += 1
+        current[2] += ts
+        current[3] += value
+    return [(int(tsum / count), vsum / count)
+            for _, count, tsum, vsum in buckets]
@@ -1,8 +1,12 @@
 import re
 import os
+import heapq
+import base64
 import hashlib
+import shutil
 import string
 import random
+import tempfile
 
 from cryptography.hazmat.primitives.ciphers import Cipher
 from cryptography.hazmat.primitives.ciphers import algorithms
@@ -140,3 +144,185 @@ def random_chars(size=12, chars=DEFAULT_CHARSET):
         a string of random characters
     """
     return ''.join(random.choice(chars) for _ in range(size))
+
+
+def _ldif_records(f):
+    """Splits an open LDIF file into records. Comments and the version line
+    are dropped.
+
+    Yields:
+        tuple of the line number where the record starts and the list of its
+        lines, each ending with a newline
+    """
+    record = []
+    start = 0
+    for lineno, line in enumerate(f, 1):
+        if not line.strip():
+            if record:
+                yield start, record
+                record = []
+            continue
+        if line.startswith("#") or (not record and
+                                    line.startswith("version:")):
+            continue
+        if not record:
+            start = lineno
+        if not line.endswith("\n"):
+            # last line of a file without a final newline, the records are
+            # written back separated by blank lines
+            line += "\n"
+        record.append(line)
+    if record:
+        yield start, record
+
+
+def _ldif_dn(record):
+    """Returns the DN of a LDIF record, unfolding the continuation lines and
+    decoding base64 values. Returns None if the record doesn't start with a
+    DN.
+    """
+    value = record[0].rstrip("\r\n")
+    for line in record[1:]:
+        if not line.startswith(" "):
+            break
+        value += line[1:].rstrip("\r\n")
+
+    if value.lower().startswith("dn::"):
+        return base64.b64decode(value[4:].strip())
+    if value.lower().startswith("dn:"):
+        return value[3:].strip()
+    return None
+
+
+def split_dn(dn):
+    """Splits a DN into its RDNs, honoring the escaped commas.
+
+    Returns:
+        list of the normalized (lowercase, stripped) RDNs
+    """
+    return [rdn.strip().lower() for rdn in re.split(r"(?<!\\),", dn)
+            if rdn.strip()]
+
+
+def _sorted_lines(path, tmpdir, chunk_size=100000):
+    """Sorts the lines of a file without loading it at once: sorted runs of
+    chunk_size lines are written to temporary files and merged.
+
+    Yields:
+        the lines of the file in sorted order
+    """
+    runs = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = [line for _, line in zip(xrange(chunk_size), f)]
+            if not chunk:
+                break
+            chunk.sort()
+            run = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False)
+            with run:
+                run.writelines(chunk)
+            runs.append(run.name)
+    files = [open(run, "rb") for run in runs]
+    try:
+        for line in heapq.merge(*files):
+            yield line
+    finally:
+        for f in files:
+            f.close()
+
+
+def _count_missing(keys, existing):
+    """Counts the keys missing from existing, both being sorted iterables.
+    """
+    missing = 0
+    existing = iter(existing)
+    current = next(existing, None)
+    for key in keys:
+        while current is not None and current < key:
+            current = next(existing, None)
+        if current != key:
+            missing += 1
+    return missing
+
+
+def _dn_key(rdns):
+    # one line per DN in the temporary files
+    return ",".join(rdns).replace("\\", "\\\\").replace("\n", "\\n") + "\n"
+
+
+def sort_ldif(src, dst):
+    """Validates a LDIF file and writes its entries to ``dst`` ordered so
+    that the parents come before their children, as required by slapadd in
+    quick mode. Entries are grouped by depth in temporary files, and their
+    DNs are sorted on disk to find the orphans, which keeps the memory usage
+    independent of the size of the file.
+
+    Args:
+        src (string): path of the LDIF file to sort
+        dst (string): path of the sorted file
+
+    Returns:
+        dict with the number of ``entries``, the list of ``errors`` found in
+        malformed records and the number of ``orphans``, the entries whose
+        parent is not part of the file. The suffix entries, the ones at the
+        lowest depth, are not counted as orphans.
+    """
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(dst)))
+    buckets = {}
+    dns = {}
+    parents = {}
+    errors = []
+    entries = 0
+
+    def open_file(files, depth, name):
+        if depth not in files:
+            files[depth] = open(os.path.join(
+                tmpdir, "{0}-{1}".format(name, depth)), "wb")
+        return files[depth]
+
+    try:
+        with open(src, "rb") as f:
+            for lineno, record in _ldif_records(f):
+                dn = _ldif_dn(record)
+                if dn is None:
+                    errors.append("line {0}: record doesn't start with a "
+                                  "DN".format(lineno))
+                    continue
+                rdns = split_dn(dn)
+                if not rdns or len(record) < 2:
+                    errors.append("line {0}: invalid entry {1}".format(
+                        lineno, dn))
+                    continue
+
+                depth = len(rdns)
+                bucket = open_file(buckets, depth, "entries")
+                bucket.writelines(record)
+                bucket.write("\n")
+                open_file(dns, depth, "dns").write(_dn_key(rdns))
+                open_file(parents, depth, "parents").write(
+                    _dn_key(rdns[1:]))
+                entries += 1
+
+        for f in buckets.values() + dns.values() + parents.values():
+            f.close()
+
+        orphans = 0
+        top = min(buckets) if buckets else 0
+        for depth in sorted(parents):
+            if depth <= top:
+                continue
+            existing = _sorted_lines(dns[depth - 1].name, tmpdir) \
+                if depth - 1 in dns else []
+            orphans += _count_missing(
+                _sorted_lines(parents[depth].name, tmpdir), existing)
+
+        with open(dst, "wb") as out:
+            for depth in sorted(buckets):
+                with open(buckets[depth].name, "rb") as bucket:
+                    shutil.copyfileobj(bucket, out)
+    finally:
+        for f in buckets.values() + dns.values() + parents.values():
+            f.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {"entries": entries, "errors": errors, "orphans": orphans}
@@ -3,6 +3,7 @@ from flask_migrate import Migrate
 from celery import Celery
 
 from .weblogger import WebLogger
+from .metrics import metrics
 
 from clustermgr.config import Config
 
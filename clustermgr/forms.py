@@ -5,7 +5,7 @@ except ImportError:
 from wtforms import StringField, SelectField, BooleanField, IntegerField, \
     PasswordField, RadioField, SubmitField
 from wtforms.validators import DataRequired, Regexp, AnyOf, \
-    ValidationError, URL, IPAddress
+    ValidationError, URL, IPAddress, Optional, NumberRange
 from flask_wtf.file import FileField, FileRequired, FileAllowed
 
 
@@ -68,6 +68,9 @@ class LDIFForm(FlaskForm):
         FileRequired(),
         FileAllowed(['ldif'], 'Upload OpenLDAP slapcat exported ldif files only!')
     ])
+    fast_load = BooleanField('Fast bulk load (recommended for large LDIF files)', default=False)
+    tool_threads = IntegerField('Tool threads used by the fast bulk load', default=4,
+                                validators=[Optional(), NumberRange(min=1, max=64)])
 
 
 class KeyRotationForm(FlaskForm):
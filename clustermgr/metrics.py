@@ -0,0 +1,262 @@
+"""metrics.py - flask extension collecting the runtime metrics of the
+application in Redis and exposing them in the Prometheus text format.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+
+
+#: upper bounds in seconds of the buckets of the histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300, 900, 1800)
+
+
+class Metric(object):
+    """A counter, gauge or histogram declared with :class:`Metrics`. The
+    label values are given as keyword arguments when recording a value.
+    """
+
+    def __init__(self, registry, name, kind, help, buckets=None):
+        self.registry = registry
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.buckets = tuple(buckets or ())
+
+    def inc(self, amount=1, **labels):
+        """Increments a counter or a gauge.
+        """
+        self.registry._record(self, _labels(labels), 'incr', amount)
+
+    def set(self, value, **labels):
+        """Sets the value of a gauge.
+        """
+        self.registry._record(self, _labels(labels), 'set', value)
+
+    def observe(self, value, **labels):
+        """Records a value in a histogram.
+        """
+        key = _labels(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.registry._record(self, "{0}\tbucket\t{1}".format(key, index),
+                              'incr', 1)
+        self.registry._record(self, "{0}\tsum".format(key), 'incr', value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager observing the time spent in the block, whether it
+        raised an exception or not.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+
+def _labels(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v))
+                          for k, v in pairs) + '}'
+
+
+class Metrics(object):
+    """Metrics is a registry of counters, gauges and histograms shared by the
+    web application and the celery workers through Redis.
+
+    Every process aggregates the values it records in memory and adds them to
+    the Redis hashes of the metrics at most every METRICS_FLUSH_INTERVAL
+    seconds, so recording a value doesn't cost a request to Redis. The
+    values of all the processes are summed up in Redis.
+
+    Configuration:
+        The Redis instance is set with REDIS_HOST, REDIS_PORT and
+        REDIS_LOG_DB, like the one of :class:`WebLogger`. The values recorded
+        before init_app() is called are discarded.
+
+    Declaration::
+
+        from clustermgr.metrics import metrics
+
+        REQUESTS = metrics.counter('requests_total', 'Requests received')
+        REQUESTS.inc(endpoint='home')
+
+    Exposition:
+        Refer render()
+    """
+
+    def __init__(self, app=None):
+        self.r = None
+        self.prefix = 'metrics'
+        self.flush_interval = 5
+        self._metrics = {}
+        self._collectors = []
+        self._pending = {}
+        self._announced = set()
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.r = redis.Redis(host=app.config['REDIS_HOST'],
+                             port=app.config['REDIS_PORT'],
+                             db=app.config['REDIS_LOG_DB'])
+        # outside the keys of the WebLogger, prefixed with the app name
+        self.prefix = "metrics:{0}".format(app.name)
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+
+    def _declare(self, name, kind, help, buckets=None):
+        if name not in self._metrics:
+            self._metrics[name] = Metric(self, name, kind, help, buckets)
+        return self._metrics[name]
+
+    def counter(self, name, help):
+        """Declares a counter, a value which only goes up.
+        """
+        return self._declare(name, 'counter', help)
+
+    def gauge(self, name, help):
+        """Declares a gauge, a value which can go up and down.
+        """
+        return self._declare(name, 'gauge', help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        """Declares a histogram counting the observed values in buckets.
+        """
+        return self._declare(name, 'histogram', help, buckets)
+
+    def collector(self, func):
+        """Registers a function called by render() to add values computed at
+        scrape time. The function returns a list of (metric, labels, value)
+        tuples where metric is a gauge or counter declared by this registry
+        and labels a dict.
+        """
+        if func not in self._collectors:
+            self._collectors.append(func)
+        return func
+
+    def _record(self, metric, field, op, value):
+        with self._lock:
+            key = (metric.name, field)
+            if op == 'incr' and key in self._pending:
+                value += self._pending[key][1]
+            self._pending[key] = (op, value)
+            due = time.time() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Adds the values recorded by this process to Redis.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if self.r is None or not pending:
+            return
+
+        pipe = self.r.pipeline(transaction=False)
+        for name in set(name for name, _ in pending) - self._announced:
+            metric = self._metrics[name]
+            pipe.hset("{0}:meta".format(self.prefix), name, json.dumps({
+                'type': metric.kind, 'help': metric.help,
+                'buckets': metric.buckets}))
+        for (name, field), (op, value) in pending.iteritems():
+            key = "{0}:{1}".format(self.prefix, name)
+            if op == 'set':
+                pipe.hset(key, field, value)
+            else:
+                pipe.hincrbyfloat(key, field, value)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            # the metrics are not worth failing the caller for
+            return
+        self._announced.update(name for name, _ in pending)
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text exposition format.
+        """
+        self.flush()
+        meta = self.r.hgetall("{0}:meta".format(self.prefix))
+        names = sorted(meta)
+        pipe = self.r.pipeline(transaction=False)
+        for name in names:
+            pipe.hgetall("{0}:{1}".format(self.prefix, name))
+        stored = dict(zip(names, pipe.execute()))
+
+        collected = {}
+        for collector in self._collectors:
+            for metric, labels, value in collector():
+                if metric.name not in meta:
+                    meta[metric.name] = json.dumps({
+                        'type': metric.kind, 'help': metric.help,
+                        'buckets': metric.buckets})
+                collected.setdefault(metric.name, {})[_labels(labels)] = value
+
+        lines = []
+        for name in sorted(meta):
+            info = json.loads(meta[name])
+            values = dict(stored.get(name) or {})
+            values.update(collected.get(name, {}))
+            lines.append("# HELP {0} {1}".format(name, info['help']))
+            lines.append("# TYPE {0} {1}".format(name, info['type']))
+            if info['type'] == 'histogram':
+                lines.extend(self._render_histogram(name, info['buckets'],
+                                                    values))
+                continue
+            for key in sorted(values):
+                lines.append("{0}{1} {2}".format(
+                    name, _format_labels(json.loads(key)),
+                    repr(float(values[key]))))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histogram(name, buckets, values):
+        series = {}
+        for field, value in values.iteritems():
+            parts = field.split("\t")
+            entry = series.setdefault(parts[0], {'buckets': {}, 'sum': 0.0})
+            if parts[1] == 'sum':
+                entry['sum'] = float(value)
+            else:
+                entry['buckets'][int(parts[2])] = float(value)
+
+        lines = []
+        for key in sorted(series):
+            labels = json.loads(key)
+            entry = series[key]
+            total = 0.0
+            for index, bound in enumerate(list(buckets) + ['+Inf']):
+                total += entry['buckets'].get(index, 0.0)
+                lines.append("{0}_bucket{1} {2}".format(
+                    name, _format_labels(labels, [('le', bound)]),
+                    repr(total)))
+            lines.append("{0}_sum{1} {2}".format(
+                name, _format_labels(labels), repr(entry['sum'])))
+            lines.append("{0}_count{1} {2}".format(
+                name, _format_labels(labels), repr(total)))
+        return lines
+
+
+#: The registry of the application, initialized by create_app()
+metrics = Metrics()
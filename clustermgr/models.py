@@ -1,7 +1,9 @@
+import json
 from datetime import datetime
 from datetime import timedelta
 
 from clustermgr.extensions import db
+from clustermgr.core.timeseries import Series
 
 from sqlalchemy.orm import relationship, backref
 
@@ -58,6 +60,244 @@ class LDAPServer(db.Model):
         return '<Server %s:%d>' % (self.hostname, self.port)
 
 
+class ReplicationStatus(db.Model):
+    __tablename__ = "replication_status"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # the consumer whose replication is monitored
+    consumer_id = db.Column(db.Integer, db.ForeignKey('ldap_server.id'),
+                            unique=True)
+    consumer = relationship("LDAPServer", backref=backref(
+        "replication_status", uselist=False, cascade="all, delete-orphan"))
+
+    # latest contextCSN of the provider and of the consumer
+    provider_csn = db.Column(db.String(64))
+    consumer_csn = db.Column(db.String(64))
+
+    # replication lag in seconds
+    lag = db.Column(db.Float)
+
+    # changes logged in the provider's accesslog not yet in the consumer
+    pending_changes = db.Column(db.Integer)
+
+    # error raised while reading the status, if any
+    error = db.Column(db.Text)
+
+    # timestamp of the check
+    checked_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            "consumer": self.consumer.hostname,
+            "provider": self.consumer.provider.hostname
+            if self.consumer.provider else None,
+            "provider_csn": self.provider_csn,
+            "consumer_csn": self.consumer_csn,
+            "lag": self.lag,
+            "pending_changes": self.pending_changes,
+            "error": self.error,
+            "checked_at": self.checked_at.isoformat() + "Z"
+            if self.checked_at else None,
+        }
+
+
+class ServerHealth(db.Model):
+    __tablename__ = "server_health"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # the probed server, ``ldap`` for a LDAPServer or ``oxauth`` for an
+    # OxauthServer, and its id
+    server_type = db.Column(db.String(10))
+    server_id = db.Column(db.Integer)
+    hostname = db.Column(db.String(255))
+
+    # time taken to open a TCP connection to the service port (seconds)
+    connect_time = db.Column(db.Float)
+
+    # time taken to connect and bind to the LDAP server (seconds)
+    bind_time = db.Column(db.Float)
+
+    # whether the server accepted a SSH connection
+    ssh = db.Column(db.Boolean)
+
+    # status of the solserver service, ``running`` or ``stopped``
+    solserver = db.Column(db.String(10))
+
+    # errors of the failed checks, one per line
+    error = db.Column(db.Text)
+
+    # timestamp of the probe
+    checked_at = db.Column(db.DateTime, index=True)
+
+    @property
+    def healthy(self):
+        return not self.error
+
+    @classmethod
+    def latest(cls, server_type):
+        """Returns the last probe of every server of the given type as a
+        dict keyed by the server id. Only the last probes are loaded, not the
+        whole history.
+        """
+        newest = db.session.query(
+            cls.server_id, db.func.max(cls.checked_at).label('checked_at')
+        ).filter_by(server_type=server_type).group_by(
+            cls.server_id).subquery()
+        checks = cls.query.filter_by(server_type=server_type).join(
+            newest, db.and_(cls.server_id == newest.c.server_id,
+                            cls.checked_at == newest.c.checked_at))
+        # probes of a server stored at the same time are unlikely but
+        # possible, any of them will do
+        return dict((check.server_id, check) for check in checks)
+
+    def to_dict(self):
+        return {
+            "server_type": self.server_type,
+            "server_id": self.server_id,
+            "hostname": self.hostname,
+            "connect_time": self.connect_time,
+            "bind_time": self.bind_time,
+            "ssh": self.ssh,
+            "solserver": self.solserver,
+            "error": self.error,
+            "checked_at": self.checked_at.isoformat() + "Z"
+            if self.checked_at else None,
+        }
+
+
+class MonitorSample(db.Model):
+    __tablename__ = "monitor_sample"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # the server whose cn=monitor backend was read
+    server_id = db.Column(db.Integer, db.ForeignKey('ldap_server.id'),
+                          unique=True)
+    server = relationship("LDAPServer", backref=backref(
+        "monitor_sample", uselist=False, cascade="all, delete-orphan"))
+
+    # JSON encoded values read from cn=monitor in the latest sample
+    counters = db.Column(db.Text)
+
+    # JSON encoded per second rates of the counters since the sample before
+    rates = db.Column(db.Text)
+
+    # error raised while reading the sample, if any
+    error = db.Column(db.Text)
+
+    # timestamp of the latest sample
+    sampled_at = db.Column(db.DateTime)
+
+    @property
+    def counter_values(self):
+        return json.loads(self.counters) if self.counters else {}
+
+    @property
+    def rate_values(self):
+        return json.loads(self.rates) if self.rates else {}
+
+    def to_dict(self):
+        return {
+            "server": self.server.hostname,
+            "counters": self.counter_values,
+            "rates": self.rate_values,
+            "error": self.error,
+            "sampled_at": self.sampled_at.isoformat() + "Z"
+            if self.sampled_at else None,
+        }
+
+
+class MetricSeries(db.Model):
+    __tablename__ = "metric_series"
+    __table_args__ = (db.UniqueConstraint('server', 'metric'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # hostname of the server the metric is about, ``manager`` for the
+    # metrics of the cluster manager itself
+    server = db.Column(db.String(255))
+
+    # name of the metric like ``replication.lag``
+    metric = db.Column(db.String(100))
+
+    # the history of the metric serialized by core.timeseries.Series
+    data = db.Column(db.LargeBinary)
+
+    # timestamp of the last point
+    updated_at = db.Column(db.DateTime)
+
+    @property
+    def series(self):
+        return Series.loads(self.data)
+
+    @classmethod
+    def add_points(cls, server, metric, points):
+        """Adds points to the history of a metric, loading and storing its
+        series once. The change has to be committed by the caller.
+
+        The series are only written by the flush_metric_series task, the
+        other processes queue their samples in redis with
+        :func:`clustermgr.tasks.monitoring.record_sample`.
+
+        Args:
+            server (string): hostname of the server the metric is about
+            metric (string): name of the metric
+            points (list): (unix time, value) tuples sorted by time
+        """
+        if not points:
+            return
+        row = cls.query.filter_by(server=server, metric=metric).first()
+        if not row:
+            row = cls(server=server, metric=metric)
+            db.session.add(row)
+        series = row.series
+        for timestamp, value in points:
+            series.add(timestamp, value)
+        row.data = series.dumps()
+        row.updated_at = datetime.utcfromtimestamp(points[-1][0])
+
+
+class SetupStep(db.Model):
+    __tablename__ = "setup_step"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # the server being setup
+    server_id = db.Column(db.Integer, db.ForeignKey('ldap_server.id'))
+    server = relationship("LDAPServer", backref=backref(
+        "setup_steps", order_by="SetupStep.started_at",
+        cascade="all, delete-orphan"))
+
+    # id of the celery task which ran the step
+    task_id = db.Column(db.String(64))
+
+    # ``step`` for a step of the setup, ``command`` for a command run in it
+    kind = db.Column(db.String(10))
+
+    # name of the step or the command line
+    name = db.Column(db.Text)
+
+    # name of the step the command was run in
+    step = db.Column(db.String(100))
+
+    # start time and duration in seconds
+    started_at = db.Column(db.DateTime)
+    duration = db.Column(db.Float)
+
+    def to_dict(self):
+        return {
+            "task_id": self.task_id,
+            "kind": self.kind,
+            "name": self.name,
+            "step": self.step,
+            "started_at": self.started_at.isoformat() + "Z"
+            if self.started_at else None,
+            "duration": self.duration,
+        }
+
+
 class AppConfiguration(db.Model):
     __tablename__ = 'appconfig'
 
@@ -4,7 +4,10 @@ import ldap
 import StringIO
 import json
 import re
-from datetime import datetime
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 import requests
 from fabric.api import run, execute, cd, put, env, get
@@ -16,9 +19,12 @@ from clustermgr.extensions import celery, db, wlogger
 from clustermgr.models import LDAPServer, AppConfiguration, KeyRotation, \
         OxauthServer, OxelevenKeyID
 from clustermgr.core.ldaplib import ldap_conn, search_from_ldap
-from clustermgr.core.utils import decrypt_text, random_chars
+from clustermgr.core.utils import decrypt_text, random_chars, sort_ldif
 from clustermgr.core.ox11 import generate_key, delete_key
 from clustermgr.core.keygen import generate_jks
+from clustermgr.core.fanout import FanOut, upload, parallel_map
+from clustermgr.core.remote import pool as remote_pool
+from clustermgr.tasks.cluster import connect, run_command as run_remote
 
 ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
 
@@ -51,26 +57,212 @@ def run_command(taskid, command):
     return output
 
 
-def import_ldif(taskid, ldiffile, server):
-    wlogger.log(taskid, "Copying {0} to /tmp/init.ldif".format(ldiffile),
-                "debug")
+def ldif_stream(taskid, ldiffile, interval=5, chunk_size=1048576):
+    """Reads a LDIF file and yields it gzip compressed, logging the number of
+    entries, the throughput and the remaining time every ``interval``
+    seconds.
+
+    Args:
+        taskid (string): id of the task to log the progress to
+        ldiffile (string): path of the LDIF file
+        interval (int, optional): seconds between two progress messages
+        chunk_size (int, optional): bytes read from the file at a time
+
+    Yields:
+        chunks of the compressed file
+    """
+    total = os.path.getsize(ldiffile)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    entries = 0
+    read = 0
+    # an entry starts with a dn line; the tail of the previous chunk is kept
+    # to find the ones split across two chunks
+    tail = "\n"
+    start = last_report = time.time()
+
+    with open(ldiffile, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            entries += (tail + chunk).count("\ndn:")
+            tail = chunk[-3:]
+            read += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+
+            now = time.time()
+            if now - last_report >= interval:
+                last_report = now
+                rate = read / (now - start)
+                eta = (total - read) / rate if rate else 0
+                wlogger.log(taskid, "{0} entries / {1:.2f} MB/s / ETA {2}"
+                            "".format(entries, rate / 1048576,
+                                      timedelta(seconds=int(eta))),
+                            "info", entries=entries, bytes=read,
+                            total=total)
+    yield compressor.flush()
+
+    elapsed = time.time() - start
+    wlogger.log(taskid, "Sent {0} entries ({1:.1f} MB) in {2}".format(
+        entries, read / 1048576.0, timedelta(seconds=int(elapsed))),
+        "debug", entries=entries, bytes=read, total=total)
+
+
+@contextmanager
+def phase(taskid, name, timings):
+    """Logs the duration of a phase of the import and records it in the
+    ``timings`` dict.
+    """
+    wlogger.log(taskid, "Phase: {0}".format(name), "info")
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = time.time() - start
+        wlogger.log(taskid, "Phase {0} took {1:.2f}s".format(
+            name, timings[name]), "debug", phase=name,
+            duration=timings[name])
+
+
+def import_ldif(taskid, c, ldiffile, server, fast=False, tool_threads=None):
+    """Imports a LDIF file in the o=gluu database of the server. The file is
+    streamed compressed over SSH straight into the stdin of slapadd, without
+    a copy being made on the server.
+
+    In the fast mode, the LDIF is validated and sorted on the manager first,
+    then loaded with ``slapadd -q`` and the configured number of tool threads
+    while the indices of the database are disabled. The indices are restored
+    and built by a single ``slapindex`` pass after the load.
+
+    Args:
+        taskid (string): id of the task running the import
+        c (:object:`clustermgr.core.remote.RemoteClient`): client connected
+            to the server
+        ldiffile (string): path of the local LDIF file
+        server (:object:`clustermgr.models.LDAPServer`): the server
+        fast (bool, optional): use the fast bulk-load mode
+        tool_threads (int, optional): olcToolThreads set for the fast mode
+
+    Returns:
+        True if slapadd succeeded, False otherwise
+    """
+    container = None
     if server.gluu_server:
-        sloc = "gluu-server-"+server.gluu_version
-        put(ldiffile, '/opt/'+sloc+'/tmp/init.ldif')
-        run_command(taskid, chcmd(sloc, 'service solserver stop'))
-        run_command(taskid, chcmd(sloc, '/opt/symas/bin/slapadd -b o=gluu -l /tmp/init.ldif'))
-        run_command(taskid, chcmd(sloc, 'service solserver start'))
-        run_command(taskid, 'rm /opt/'+sloc+'/tmp/init.ldif')
-    else:
-        put(ldiffile, '/tmp/init.ldif')
-        run_command(taskid, 'service solserver stop')
-        run_command(taskid, '/opt/symas/bin/slapadd -b o=gluu -l /tmp/init.ldif')
-        run_command(taskid, 'service solserver start')
-        run_command(taskid, 'rm /tmp/init.ldif')
+        container = "/opt/gluu-server-" + server.gluu_version
+    timings = {}
+    sorted_file = None
+    dbfile = None
+
+    try:
+        if fast:
+            with phase(taskid, "validate and sort", timings):
+                sorted_file = ldiffile + ".sorted"
+                stats = sort_ldif(ldiffile, sorted_file)
+            for error in stats["errors"][:20]:
+                wlogger.log(taskid, error, "error")
+            if stats["errors"]:
+                wlogger.log(taskid, "{0} malformed records in the LDIF file. "
+                            "Nothing imported.".format(len(stats["errors"])),
+                            "error")
+                return False
+            if stats["orphans"]:
+                wlogger.log(taskid, "{0} entries have no parent in the LDIF "
+                            "file".format(stats["orphans"]), "warning")
+            wlogger.log(taskid, "{0} entries validated and sorted".format(
+                stats["entries"]), "success")
+            ldiffile = sorted_file
+
+        with phase(taskid, "stop", timings):
+            run_remote(taskid, c, 'service solserver stop', container)
+
+        if fast:
+            with phase(taskid, "prepare", timings):
+                dbfile = _disable_indices(taskid, c, container, tool_threads)
+
+        command = "gzip -dc | /opt/symas/bin/slapadd -b o=gluu -l /dev/stdin"
+        if fast:
+            command = command.replace("slapadd", "slapadd -q")
+        if container:
+            command = 'chroot {0} /bin/bash -c "{1}"'.format(container,
+                                                              command)
+
+        try:
+            with phase(taskid, "load", timings):
+                wlogger.log(taskid, "Streaming {0} to slapadd".format(
+                    ldiffile), "debug")
+                wlogger.log(taskid, command, "debug")
+                out, err, status = c.pipe(command,
+                                          ldif_stream(taskid, ldiffile))
+                if out:
+                    wlogger.log(taskid, out, "debug")
+                if status != 0:
+                    wlogger.log(taskid, err or "slapadd exited with status "
+                                "{0}".format(status), "error")
+                elif err:
+                    wlogger.log(taskid, err, "debug")
+        finally:
+            # the indices must come back even when the stream failed
+            if dbfile:
+                run_remote(taskid, c, "mv {0}.bak {0}".format(dbfile),
+                           container)
+
+        if dbfile:
+            with phase(taskid, "index", timings):
+                run_remote(taskid, c, "/opt/symas/bin/slapindex -q -b o=gluu",
+                           container, stream=True)
+
+        with phase(taskid, "start", timings):
+            run_remote(taskid, c, 'service solserver start', container)
+
+        wlogger.log(taskid, "Import timings: {0}".format(", ".join(
+            "{0} {1:.2f}s".format(name, duration)
+            for name, duration in sorted(timings.items(),
+                                         key=lambda t: t[1], reverse=True))),
+            "info", timings=timings)
+        return status == 0
+    finally:
+        # the sorted copy is removed even when the sort or the load failed
+        if sorted_file and os.path.exists(sorted_file):
+            os.remove(sorted_file)
+
+
+def _disable_indices(taskid, c, container, tool_threads):
+    """Sets olcToolThreads and removes the olcDbIndex values of the o=gluu
+    database from the slapd.d of a stopped server. The database definition is
+    backed up next to it so that the indices can be restored for slapindex.
+
+    The CRC32 comment of the modified files is dropped, as slapd skips the
+    checksum verification of files without one.
+
+    Returns:
+        path of the slapd.d file of the database or None if it wasn't found
+    """
+    confdir = "/opt/symas/etc/openldap/slapd.d"
+    if tool_threads:
+        conf = confdir + "/cn=config.ldif"
+        run_remote(taskid, c, "sed -i '/^# CRC32/d; /^olcToolThreads:/d; "
+                   "/^dn: cn=config$/a olcToolThreads: {0}' {1}".format(
+                       int(tool_threads), conf), container)
+
+    out = run_remote(taskid, c, "grep -l '^olcSuffix: o=gluu' {0}/cn=config/"
+                     "olcDatabase=*.ldif".format(confdir), container)
+    dbfile = None
+    for line in out.splitlines():
+        if line.strip().endswith(".ldif"):
+            dbfile = line.strip()
+            break
+    if not dbfile:
+        wlogger.log(taskid, "Cannot find the o=gluu database definition. "
+                    "Indexing during the load.", "warning")
+        return None
+
+    run_remote(taskid, c, "cp -p {0} {0}.bak && sed -i '/^# CRC32/d; "
+               "/^olcDbIndex:/d' {0}".format(dbfile), container)
+    return dbfile
 
 
 @celery.task(bind=True)
-def initialize_provider(self, server_id, use_ldif):
+def initialize_provider(self, server_id, use_ldif, fast_load=False,
+                        tool_threads=None):
     initialized = False
     s = LDAPServer.query.get(server_id)
     rootuser = 'cn=directory manager,o=gluu'
@@ -86,13 +278,21 @@ def initialize_provider(self, server_id, use_ldif):
         ]
 
     if use_ldif:
-        host = "root@{}".format(s.hostname)
         ldiffile = os.path.join(app.config['LDIF_DIR'],
                                 "{0}_init.ldif".format(server_id))
-        with settings(warn_only=True):
-            wlogger.log(taskid, "Importing the LDIF file")
-            execute(import_ldif, self.request.id, ldiffile, s,
-                    hosts=[host])
+        wlogger.log(taskid, "Importing the LDIF file")
+        c = connect(taskid, s)
+        if c is None:
+            wlogger.log(taskid, "Cannot import the LDIF file", "error")
+            return
+        try:
+            import_ldif(taskid, c, ldiffile, s, fast=fast_load,
+                        tool_threads=tool_threads)
+        except Exception:
+            # the session may be half dead, don't hand it to the next task
+            c.close()
+            raise
+        remote_pool.put(c)
 
     # Step 1: Add the Replication User DN
     wlogger.log(taskid, 'Connecting to {}'.format(s.hostname))
@@ -111,27 +311,54 @@ def initialize_provider(self, server_id, use_ldif):
             return
     # Step 2: Reconnect as replication user
     try:
-        con = ldap.initialize('ldap://{}:{}'.format(s.hostname, s.port))
-        if s.protocol == 'starttls':
-            con.start_tls_s()
-        con.bind_s(repdn, appconfig.replication_pw)
-        wlogger.log(taskid, "Authenticating as the Replication DN.", "success")
-        initialized = True
-    except ldap.SERVER_DOWN:
-        con = ldap.initialize('ldaps://{}:{}'.format(s.hostname, s.port))
-        con.bind_s(repdn, appconfig.replication_pw)
-        wlogger.log(taskid, "Authenticating as the Replication DN.", "success")
-        initialized = True
+        with ldap_conn(s.hostname, s.port, repdn, appconfig.replication_pw,
+                       starttls(s)):
+            wlogger.log(taskid, "Authenticating as the Replication DN.",
+                        "success")
+            initialized = True
     except ldap.LDAPError as e:
         wlogger.log(taskid, "%s" % e, 'error')
-    finally:
-        con.unbind()
 
     if initialized:
         s.initialized = True
         db.session.commit()
 
 
+def wait_for_entry(server, binddn, dn, present, since, timeout):
+    """Polls an LDAP server until the entry shows up in it, or is gone from
+    it, using a single connection with an exponential backoff between the
+    attempts.
+
+    Args:
+        server (:object:`clustermgr.models.LDAPServer`): server to poll
+        binddn (string): the DN to bind as
+        dn (string): DN of the entry to look for
+        present (bool): whether to wait for the entry to appear or disappear
+        since (float): timestamp of the change on the provider
+        timeout (float): seconds after which the polling is given up
+
+    Returns:
+        the seconds taken by the change to propagate, or None when it was not
+        observed before the deadline
+    """
+    delay = 0.1
+    deadline = since + timeout
+    with ldap_conn(server.hostname, server.port, binddn, server.admin_pw,
+                   starttls(server)) as con:
+        while True:
+            try:
+                found = bool(con.compare_s(dn, 'sn', 'gluu'))
+            except ldap.NO_SUCH_OBJECT:
+                found = False
+            now = time.time()
+            if found == present:
+                return now - since
+            if now > deadline:
+                return None
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, 2)
+
+
 @celery.task(bind=True)
 def replicate(self):
     taskid = self.request.id
@@ -145,14 +372,18 @@ def replicate(self):
         ('sn', ['gluu']),
         ]
     test_result = True
+    timeout = celery.conf["REPLICATION_TEST_TIMEOUT"]
+    max_workers = celery.conf["FANOUT_MAX_WORKERS"]
 
     wlogger.log(taskid, 'Available providers: {}'.format(len(providers)),
                 "debug")
     for provider in providers:
+        consumers = provider.consumers
         try:
             with ldap_conn(provider.hostname, provider.port, rootdn,
                            provider.admin_pw, starttls(provider)) as con:
                 con.add_s(dn, replication_user)
+            added_at = time.time()
             wlogger.log(taskid, "Adding test data to provider {0}".format(
                 provider.hostname), "success")
         except:
@@ -161,34 +392,39 @@ def replicate(self):
             v = sys.exc_info()[1]
             wlogger.log(taskid, str(v), "debug")
             test_result = test_result and False
-
-        consumers = provider.consumers
-        wlogger.log(taskid,
-                    'Listing consumers of provider %s' % provider.hostname)
-        # Check the consumers
-        for consumer in consumers:
-            wlogger.log(taskid, 'Verifying data in consumers: {} of {}'.format(
-                consumers.index(consumer)+1, len(consumers)))
-            try:
-                with ldap_conn(consumer.hostname, consumer.port, rootdn,
-                               consumer.admin_pw, starttls(consumer)) as con:
-                    if con.compare_s(dn, 'sn', 'gluu'):
-                        wlogger.log(
-                            taskid,
-                            'Test data is replicated and available', 'success')
-            except ldap.NO_SUCH_OBJECT:
-                wlogger.log(taskid, 'Test data is NOT replicated.', 'error')
-                test_result = test_result and False
-            except ldap.LDAPError as e:
+            continue
+
+        # Check all the consumers at once
+        wlogger.log(taskid, 'Verifying data in {0} consumers of provider '
+                    '{1}'.format(len(consumers), provider.hostname))
+        results = parallel_map(
+            lambda consumer: wait_for_entry(consumer, rootdn, dn, True,
+                                            added_at, timeout),
+            consumers, max_workers)
+        for consumer, (elapsed, err, _) in zip(consumers, results):
+            if err:
                 wlogger.log(taskid, 'Failed to connect to {0}. {1}'.format(
-                                    consumer.hostname, e), 'error')
+                    consumer.hostname, err), 'error', host=consumer.hostname)
                 test_result = test_result and False
+            elif elapsed is None:
+                wlogger.log(taskid, 'Test data is NOT replicated to {0} '
+                            'within {1}s.'.format(consumer.hostname, timeout),
+                            'error', host=consumer.hostname)
+                test_result = test_result and False
+            else:
+                wlogger.log(taskid, 'Test data is replicated and available '
+                            'in {0} after {1:.2f}s'.format(
+                                consumer.hostname, elapsed),
+                            'success', host=consumer.hostname,
+                            propagation=elapsed)
 
         # delete the entry from the provider
+        deleted_at = None
         try:
             with ldap_conn(provider.hostname, provider.port, rootdn,
                            provider.admin_pw, starttls(provider)) as con:
                 con.delete_s(dn)
+                deleted_at = time.time()
                 if con.compare_s(dn, 'sn', 'gluu'):
                     wlogger.log(taskid, 'Delete operation failed. Data exists',
                                 'error')
@@ -201,31 +437,36 @@ def replicate(self):
             wlogger.log(taskid, str(v), "debug")
             test_result = test_result and False
 
-        # verify the data is removed from the consumers
-        for consumer in consumers:
-            wlogger.log(
-                taskid,
-                "Verifying data is removed from consumers: {} of {}".format(
-                    consumers.index(consumer)+1, len(consumers)))
-            try:
-                with ldap_conn(consumer.hostname, consumer.port, rootdn,
-                               consumer.admin_pw, starttls(consumer)) as con:
-                    if con.compare_s(dn, 'sn', 'gluu'):
-                        wlogger.log(
-                            taskid,
-                            'Failed to remove test data in consumer {}'.format(
-                                consumer.hostname), 'error')
-                        test_result = test_result and False
-            except ldap.NO_SUCH_OBJECT:
-                    wlogger.log(
-                        taskid,
-                        'Test data removed from the consumer: {}'.format(
-                            consumer.hostname), 'success')
-            except ldap.LDAPError as e:
+        if deleted_at is None:
+            continue
+
+        # verify the data is removed from all the consumers at once
+        wlogger.log(taskid, 'Verifying data is removed from {0} consumers of '
+                    'provider {1}'.format(len(consumers), provider.hostname))
+        results = parallel_map(
+            lambda consumer: wait_for_entry(consumer, rootdn, dn, False,
+                                            deleted_at, timeout),
+            consumers, max_workers)
+        for consumer, (elapsed, err, _) in zip(consumers, results):
+            if err:
                 wlogger.log(
                     taskid, 'Failed to test consumer: {0}. Error: {1}'.format(
-                        consumer.hostname, e), 'error')
+                        consumer.hostname, err), 'error',
+                    host=consumer.hostname)
                 test_result = test_result and False
+            elif elapsed is None:
+                wlogger.log(
+                    taskid,
+                    'Failed to remove test data in consumer {0} within '
+                    '{1}s'.format(consumer.hostname, timeout), 'error',
+                    host=consumer.hostname)
+                test_result = test_result and False
+            else:
+                wlogger.log(
+                    taskid,
+                    'Test data removed from the consumer: {0} after '
+                    '{1:.2f}s'.format(consumer.hostname, elapsed),
+                    'success', host=consumer.hostname, propagation=elapsed)
 
     wlogger.log(taskid, 'Replication test Complete.')
     appconf = AppConfiguration.query.first()
@@ -263,12 +504,8 @@ def setup_server(self, server_id, conffile):
     # TODO find where this copy certificate routine should be injected in
     # cluster.py
 
-    # Everything is done. Set the flag to based on the messages
-    msgs = wlogger.get_messages(tid)
-    setup_success = True
-    for msg in msgs:
-        setup_success = setup_success and msg['level'] != 'error'
-    server.setup = setup_success
+    # Everything is done. Set the flag based on the errors logged
+    server.setup = not wlogger.get_summary(tid)['counts'].get('error')
     db.session.commit()
 
 
@@ -407,20 +644,19 @@ def _rotate_keys(kr, javalibs_dir, jks_path):
         db.session.commit()
 
         if kr.type == "jks":
-            def _copy_jks(path, hostname, dest_path):
-                out = put(path, dest_path)
-                if out.failed:
+            # copy the JKS file to all the oxAuth servers at once
+            servers = OxauthServer.query.all()
+            fan = FanOut(max_workers=celery.conf["FANOUT_MAX_WORKERS"],
+                         per_host=celery.conf["FANOUT_PER_HOST"])
+            results = fan.run_jobs([(server, upload(jks_path, server.jks_path))
+                                    for server in servers])
+            for result in results:
+                if not result.ok:
                     print "unable to copy JKS file to " \
-                        "oxAuth server {}".format(hostname)
+                        "oxAuth server {}".format(result.host)
                 else:
                     print "JKS file has been copied " \
-                        "to {}".format(hostname)
-
-            for server in OxauthServer.query:
-                host = "root@{}".format(server.hostname)
-                with settings(warn_only=True):
-                    execute(_copy_jks, jks_path, server.hostname,
-                            server.jks_path, hosts=[host])
+                        "to {}".format(result.host)
 
 
 @celery.task
@@ -1,14 +1,118 @@
 import re
 import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
 
 from flask import current_app as app
 
-from clustermgr.models import LDAPServer
+from clustermgr.models import LDAPServer, SetupStep
 from clustermgr.extensions import celery, wlogger, db
-from clustermgr.core.remote import RemoteClient
+from clustermgr.core.remote import pool
 
+# seconds the foreground debug run of slapd is followed before giving up
+DEBUG_TIMEOUT = 60
 
-def run_command(tid, c, command, container=None):
+
+class StepTimer(object):
+    """Times the steps of a setup task and the commands run in them.
+
+    Each finished step or command is logged to the WebLogger with the
+    ``timing`` level, carrying its ``kind``, ``step``, ``start`` (unix time)
+    and ``duration`` (seconds), and is kept to be saved as the
+    :class:`SetupStep` rows of the server.
+
+    Args:
+        tid (string): task id of the task to store the log
+        server (:object:`clustermgr.models.LDAPServer`): the server being
+            setup
+    """
+
+    def __init__(self, tid, server):
+        self.tid = tid
+        self.server = server
+        self.current = None
+        self.records = []
+
+    def record(self, kind, name, start, duration):
+        self.records.append((kind, name, self.current, start, duration))
+        wlogger.log(self.tid, name, "timing", kind=kind,
+                    step=self.current or name, start=start,
+                    duration=duration, host=self.server.hostname)
+
+    def save(self):
+        """Replaces the timings saved for the previous setup of the server
+        with the ones of this task. The change has to be committed by the
+        caller.
+        """
+        SetupStep.query.filter_by(server_id=self.server.id).delete()
+        for kind, name, step_name, start, duration in self.records:
+            db.session.add(SetupStep(
+                server_id=self.server.id, task_id=self.tid, kind=kind,
+                name=name, step=step_name, duration=duration,
+                started_at=datetime.utcfromtimestamp(start)))
+
+
+#: timers of the setup tasks running in this process, keyed by task id
+timers = {}
+
+
+@contextmanager
+def step(tid, name):
+    """Context manager timing a step of a setup task with the StepTimer of
+    the task, if it has one.
+    """
+    timer = timers.get(tid)
+    if timer is None:
+        yield
+        return
+    timer.current = name
+    start = time.time()
+    try:
+        yield
+    finally:
+        timer.current = None
+        timer.record('step', name, start, time.time() - start)
+
+
+def connect(tid, server):
+    """Borrows a connected RemoteClient for the server from the process wide
+    connection pool. The hostname is tried first and the IP address is used
+    only when the hostname connection fails.
+
+    Args:
+        tid (string): task id of the task to store the log
+        server (:object:`clustermgr.models.LDAPServer`): the server to
+            connect to
+
+    Returns:
+        a connected :object:`clustermgr.core.remote.RemoteClient` or None when
+        both the attempts fail. The client should be given back with
+        pool.put() once the task is done with it, or closed if the task
+        failed while using it.
+    """
+    wlogger.log(tid, "Connecting to the server %s" % server.hostname)
+    try:
+        return pool.get(server.hostname)
+    except Exception as e:
+        wlogger.log(tid, "Cannot establish SSH connection {0}".format(e),
+                    "warning")
+
+    if not server.ip:
+        return None
+
+    wlogger.log(tid, "Retrying with the IP address")
+    try:
+        return pool.get(server.ip)
+    except Exception as e:
+        wlogger.log(tid, "Cannot establish SSH connection {0}".format(e),
+                    "error")
+    return None
+
+
+def run_command(tid, c, command, container=None, stream=False, timeout=None,
+                tail=200):
     """Shorthand for RemoteClient.run(). This function automatically logs
     the commands output at appropriate levels to the WebLogger to be shared
     in the web frontend.
@@ -20,15 +124,37 @@ def run_command(tid, c, command, container=None):
         command (string): the command to be run on the remote server
         container (string, optional): location where the Gluu Server container
             is installed. For standalone LDAP servers this is not necessary.
+        stream (bool, optional): forward the output to the WebLogger line by
+            line while the command runs, instead of once it has exited
+        timeout (int, optional): seconds after which a streamed command is
+            abandoned
+        tail (int, optional): number of lines of a streamed command kept in
+            memory for the return value
 
     Returns:
-        the output of the command or the err thrown by the command as a string
+        the output of the command or the err thrown by the command as a string.
+        For streamed commands only the last ``tail`` lines are returned.
     """
     if container:
         command = 'chroot {0} /bin/bash -c "{1}"'.format(container,
                                                          command)
 
     wlogger.log(tid, command, "debug")
+    start = time.time()
+    try:
+        if stream:
+            return _stream_command(tid, c, command, timeout, tail)
+        return _run_command(tid, c, command)
+    finally:
+        if tid in timers:
+            timers[tid].record('command', command, start,
+                               time.time() - start)
+
+
+def _run_command(tid, c, command):
+    """Runs the command with RemoteClient.run() and logs its output once it
+    has exited.
+    """
     cin, cout, cerr = c.run(command)
     output = ''
     if cout:
@@ -44,6 +170,33 @@ def run_command(tid, c, command, container=None):
     return output
 
 
+def _stream_command(tid, c, command, timeout, tail):
+    """Runs the command with RemoteClient.stream() and logs each line as it
+    arrives. The final verdict on stderr follows the same rules as
+    run_command() so a streamed command fails the task in the same cases.
+    """
+    lines = deque(maxlen=tail)
+    has_err = False
+    succeeded = False
+    for name, line in c.stream(command, timeout=timeout):
+        lines.append(line)
+        if name == 'stderr':
+            has_err = True
+            # slaptest sends its success message over stderr
+            if 'config file testing succeeded' in line:
+                succeeded = True
+                wlogger.log(tid, line, "success")
+                continue
+            wlogger.log(tid, line, "warning")
+        else:
+            wlogger.log(tid, line, "debug")
+
+    if has_err and not succeeded:
+        wlogger.log(tid, "Command reported errors: {0}".format(command),
+                    "error")
+    return '\n'.join(lines)
+
+
 def upload_file(tid, c, local, remote):
     """Shorthand for RemoteClient.upload(). This function automatically handles
     the logging of events to the WebLogger
@@ -59,6 +212,45 @@ def upload_file(tid, c, local, remote):
     wlogger.log(tid, out, 'error' if 'Error' in out else 'success')
 
 
+def sync_files(tid, c, files, remote_dir):
+    """Shorthand for RemoteClient.sync_files(). This function automatically
+    handles the logging of events to the WebLogger
+
+    Args:
+        tid (string): id of the task running the command
+        c (:object:`clustermgr.core.remote.RemoteClient`): client to be used
+            for the SSH communication
+        files (dict): mapping of the remote file name to the local file path
+        remote_dir (string): location of the files in remote server
+    """
+    uploaded, err = c.sync_files(files, remote_dir)
+    if err:
+        wlogger.log(tid, err, 'error')
+        return
+    for name in uploaded:
+        wlogger.log(tid, "Upload successful. File at: {0}".format(
+            os.path.join(remote_dir, name)), 'success')
+    unchanged = len(files) - len(uploaded)
+    if unchanged:
+        wlogger.log(tid, "{0} file(s) already up to date in {1}".format(
+            unchanged, remote_dir), 'success')
+
+
+def schema_files(*folders):
+    """Lists the schema files in the given local folders. Files in the later
+    folders take precedence over the files of the same name in the earlier
+    ones.
+
+    Returns:
+        dict mapping the file name to its local path
+    """
+    files = {}
+    for folder in folders:
+        for schema in os.listdir(folder):
+            files[schema] = os.path.join(folder, schema)
+    return files
+
+
 def download_file(tid, c, remote, local):
     """Shorthand for RemoteClient.download(). This function automatically handles
     the logging of events to the WebLogger
@@ -74,6 +266,23 @@ def download_file(tid, c, remote, local):
     wlogger.log(tid, out, 'error' if 'Error' in out else 'success')
 
 
+def data_directories(conffile):
+    """Lists the database directories configured in a slapd.conf file.
+
+    Args:
+        conffile (string): path of the slapd.conf file
+
+    Returns:
+        list of the paths given in the ``directory`` directives
+    """
+    folders = []
+    with open(conffile, 'r') as conf:
+        for line in conf:
+            if re.match('^directory', line):
+                folders.append(line.split()[1].strip('"'))
+    return folders
+
+
 @celery.task(bind=True)
 def setup_server(self, server_id, conffile):
     """This Task sets up a standalone server with only OpenLDAP installed as
@@ -90,147 +299,166 @@ def setup_server(self, server_id, conffile):
     server = LDAPServer.query.get(server_id)
     tid = self.request.id
 
-    wlogger.log(tid, "Connecting to the server %s" % server.hostname)
-    c = RemoteClient(server.hostname)
-    try:
-        c.startup()
-    except Exception as e:
-        wlogger.log(tid, "Cannot establish SSH connection {0}".format(e),
-                    "error")
-
-    wlogger.log(tid, "Retrying with the IP address")
-    c = RemoteClient(server.ip)
-    try:
-        c.startup()
-    except Exception as e:
-        wlogger.log(tid, "Cannot establish SSH connection {0}".format(e),
-                    "error")
+    c = connect(tid, server)
+    if c is None:
         wlogger.log(tid, "Ending server setup process.", "error")
         return False
 
-    wlogger.log(tid, 'Starting premilinary checks')
-    # 1. Check OpenLDAP is installed
-    if c.exists('/opt/symas/bin/slaptest'):
-        wlogger.log(tid, 'Checking if OpenLDAP is installed', 'success')
+    timer = timers[tid] = StepTimer(tid, server)
+    try:
+        _setup_server(tid, c, server, conffile)
+    except Exception:
+        # the session may be half dead, don't hand it to the next task
+        c.close()
+        raise
     else:
-        wlogger.log(tid, 'Cheking if OpenLDAP is installed', 'fail')
-        wlogger.log(tid, 'Kindly install OpenLDAP on the server and refresh'
-                    ' this page to try setup again.')
-        return
+        pool.put(c)
+    finally:
+        del timers[tid]
+        timer.save()
+        db.session.commit()
 
-    # 2. symas-openldap.conf file exists
-    if c.exists('/opt/symas/etc/openldap/symas-openldap.conf'):
-        wlogger.log(tid, 'Checking symas-openldap.conf exists', 'success')
-    else:
-        wlogger.log(tid, 'Checking if symas-openldap.conf exists', 'fail')
-        wlogger.log(tid, 'Configure OpenLDAP with /opt/gluu/etc/openldap'
-                    '/symas-openldap.conf', 'warning')
-        return
 
-    # 3. Certificates
-    if server.tls_cacert:
-        if c.exists(server.tls_cacert):
-            wlogger.log(tid, 'Checking TLS CA Certificate', 'success')
-        else:
-            wlogger.log(tid, 'Checking TLS CA Certificate', 'fail')
-    if server.tls_servercert:
-        if c.exists(server.tls_servercert):
-            wlogger.log(tid, 'Checking TLS Server Certificate', 'success')
+def _setup_server(tid, c, server, conffile):
+    """Runs the setup steps of :func:`setup_server` with the connected client.
+    """
+    with step(tid, "Preliminary checks"):
+        wlogger.log(tid, 'Starting premilinary checks')
+        # All the paths needed by the checks below are probed in one go
+        folders = data_directories(conffile)
+        certs = [server.tls_cacert, server.tls_servercert,
+                 server.tls_serverkey]
+        paths = c.exists_many(
+            ['/opt/symas/bin/slaptest',
+             '/opt/symas/etc/openldap/symas-openldap.conf'] +
+            [cert for cert in certs if cert] + folders)
+
+        # 1. Check OpenLDAP is installed
+        if paths['/opt/symas/bin/slaptest'].exists:
+            wlogger.log(tid, 'Checking if OpenLDAP is installed', 'success')
         else:
-            wlogger.log(tid, 'Checking TLS Server Certificate', 'fail')
-    if server.tls_serverkey:
-        if c.exists(server.tls_serverkey):
-            wlogger.log(tid, 'Checking TLS Server Key', 'success')
+            wlogger.log(tid, 'Cheking if OpenLDAP is installed', 'fail')
+            wlogger.log(tid, 'Kindly install OpenLDAP on the server and '
+                        'refresh this page to try setup again.')
+            return
+
+        # 2. symas-openldap.conf file exists
+        if paths['/opt/symas/etc/openldap/symas-openldap.conf'].exists:
+            wlogger.log(tid, 'Checking symas-openldap.conf exists', 'success')
         else:
-            wlogger.log(tid, 'Checking TLS Server Key', 'fail')
+            wlogger.log(tid, 'Checking if symas-openldap.conf exists', 'fail')
+            wlogger.log(tid, 'Configure OpenLDAP with /opt/gluu/etc/openldap'
+                        '/symas-openldap.conf', 'warning')
+            return
+
+        # 3. Certificates
+        if server.tls_cacert:
+            if paths[server.tls_cacert].exists:
+                wlogger.log(tid, 'Checking TLS CA Certificate', 'success')
+            else:
+                wlogger.log(tid, 'Checking TLS CA Certificate', 'fail')
+        if server.tls_servercert:
+            if paths[server.tls_servercert].exists:
+                wlogger.log(tid, 'Checking TLS Server Certificate', 'success')
+            else:
+                wlogger.log(tid, 'Checking TLS Server Certificate', 'fail')
+        if server.tls_serverkey:
+            if paths[server.tls_serverkey].exists:
+                wlogger.log(tid, 'Checking TLS Server Key', 'success')
+            else:
+                wlogger.log(tid, 'Checking TLS Server Key', 'fail')
 
     # 4. Data directories
-    wlogger.log(tid, "Checking for data and schema folders for LDAP")
-    conf = open(conffile, 'r')
-    for line in conf:
-        if re.match('^directory', line):
-            folder = line.split()[1]
-            if not c.exists(folder):
+    with step(tid, "Data directories"):
+        wlogger.log(tid, "Checking for data and schema folders for LDAP")
+        for folder in folders:
+            if not paths[folder].exists:
                 run_command(tid, c, 'mkdir -p '+folder)
             else:
                 wlogger.log(tid, folder, 'success')
 
     # 5. Copy Gluu Schema files
-    wlogger.log(tid, "Copying Schema files to server")
-    if not c.exists('/opt/gluu/schema/openldap'):
-        run_command(tid, c, 'mkdir -p /opt/gluu/schema/openldap')
-    gluu_schemas = os.listdir(os.path.join(app.static_folder, 'schema'))
-    for schema in gluu_schemas:
-        upload_file(tid, c, os.path.join(app.static_folder, 'schema', schema),
-                    "/opt/gluu/schema/openldap/"+schema)
     # 6. Copy User's custom schema files
-    schemas = os.listdir(app.config['SCHEMA_DIR'])
-    for schema in schemas:
-        upload_file(tid, c, os.path.join(app.config['SCHEMA_DIR'], schema),
-                    "/opt/gluu/schema/openldap/"+schema)
+    with step(tid, "Schema files"):
+        wlogger.log(tid, "Copying Schema files to server")
+        sync_files(tid, c,
+                   schema_files(os.path.join(app.static_folder, 'schema'),
+                                app.config['SCHEMA_DIR']),
+                   '/opt/gluu/schema/openldap')
 
     # 7. Setup slapd.conf
-    wlogger.log(tid, "Copying slapd.conf file to remote server")
-    upload_file(tid, c, conffile, '/opt/symas/etc/openldap/slapd.conf')
-
-    wlogger.log(tid, "Restarting LDAP server to validate slapd.conf")
-    # IMPORTANT:
-    # Restart allows the server to create missing mdb files for accesslog so
-    # slapd.conf -> slapd.d conversion runs without error
-    run_command(tid, c, 'service solserver restart')
+    with step(tid, "slapd.conf upload"):
+        wlogger.log(tid, "Copying slapd.conf file to remote server")
+        sync_files(tid, c, {'slapd.conf': conffile},
+                   '/opt/symas/etc/openldap')
+
+    with step(tid, "Restart"):
+        wlogger.log(tid, "Restarting LDAP server to validate slapd.conf")
+        # IMPORTANT:
+        # Restart allows the server to create missing mdb files for accesslog
+        # so slapd.conf -> slapd.d conversion runs without error
+        run_command(tid, c, 'service solserver restart')
 
     # 8. Generate OLC slapd.d
-    wlogger.log(tid, "Migrating from slapd.conf to slapd.d OnlineConfig (OLC)")
-    run_command(tid, c, 'service solserver stop')
-    run_command(tid, c, 'rm -rf /opt/symas/etc/openldap/slapd.d')
-    run_command(tid, c, 'mkdir -p /opt/symas/etc/openldap/slapd.d')
-    run_command(tid, c,
-                '/opt/symas/bin/slaptest -f /opt/symas/etc/openldap/slapd.conf'
-                ' -F /opt/symas/etc/openldap/slapd.d')
+    with step(tid, "OLC conversion"):
+        wlogger.log(tid, "Migrating from slapd.conf to slapd.d OnlineConfig "
+                    "(OLC)")
+        run_command(tid, c, 'service solserver stop')
+        run_command(tid, c, 'rm -rf /opt/symas/etc/openldap/slapd.d')
+        run_command(tid, c, 'mkdir -p /opt/symas/etc/openldap/slapd.d')
+        run_command(tid, c,
+                    '/opt/symas/bin/slaptest -f /opt/symas/etc/openldap/'
+                    'slapd.conf -F /opt/symas/etc/openldap/slapd.d',
+                    stream=True)
 
     # 9. Restart the solserver with the new configuration
-    wlogger.log(tid, "Starting LDAP server with OLC configuraion. Any future"
-                "changes to slapd.conf will have NO effect on the LDAP server")
-    log = run_command(tid, c, 'service solserver start')
-    if 'failed' in log:
-        wlogger.log(tid, "OpenLDAP server failed to start.", "error")
-        wlogger.log(tid, "Debugging slapd...", "info")
-        run_command(tid, "service solserver start -d 1")
-
-    # Everything is done. Set the flag to based on the messages
-    msgs = wlogger.get_messages(tid)
-    setup_success = True
-    for msg in msgs:
-        setup_success = setup_success and msg['level'] != 'error'
-    server.setup = setup_success
+    with step(tid, "Final start"):
+        wlogger.log(tid, "Starting LDAP server with OLC configuraion. Any "
+                    "future changes to slapd.conf will have NO effect on the "
+                    "LDAP server")
+        log = run_command(tid, c, 'service solserver start')
+        if 'failed' in log:
+            wlogger.log(tid, "OpenLDAP server failed to start.", "error")
+            wlogger.log(tid, "Debugging slapd...", "info")
+            run_command(tid, c, "service solserver start -d 1", stream=True,
+                        timeout=DEBUG_TIMEOUT)
+
+    # Everything is done. Set the flag based on the errors logged
+    server.setup = not wlogger.get_summary(tid)['counts'].get('error')
     db.session.commit()
 
 
-
 @celery.task(bind=True)
 def configure_gluu_server(self, server_id, conffile):
     server = LDAPServer.query.get(server_id)
     tid = self.request.id
-    chdir = '/opt/gluu-server-'+server.gluu_version
 
-    wlogger.log(tid, "Connecting to the server %s" % server.hostname)
-    c = RemoteClient(server.hostname)
-    try:
-        c.startup()
-    except Exception as e:
-        wlogger.log(tid, "Cannot establish SSH connection {0}".format(e),
-                    "error")
-
-    wlogger.log(tid, "Retrying with the IP address")
-    c = RemoteClient(server.ip)
-    try:
-        c.startup()
-    except Exception as e:
-        wlogger.log(tid, "Cannot establish SSH connection {0}".format(e),
-                    "error")
+    c = connect(tid, server)
+    if c is None:
         wlogger.log(tid, "Ending server setup process.", "error")
         return False
 
+    timer = timers[tid] = StepTimer(tid, server)
+    try:
+        _configure_gluu_server(tid, c, server, conffile)
+    except Exception:
+        # the session may be half dead, don't hand it to the next task
+        c.close()
+        raise
+    else:
+        pool.put(c)
+    finally:
+        del timers[tid]
+        timer.save()
+        db.session.commit()
+
+
+def _configure_gluu_server(tid, c, server, conffile):
+    """Runs the setup steps of :func:`configure_gluu_server` with the
+    connected client.
+    """
+    chdir = '/opt/gluu-server-'+server.gluu_version
+
     # Since it is a Gluu Server, a number of checks can be avoided
     # 1. Check if OpenLDAP is installed
     # 2. Check if symas-openldap.conf files exists
@@ -238,12 +466,12 @@ def configure_gluu_server(self, server_id, conffile):
 
     # 4. Existance of data directories - this is necassr check as we will be
     #    enabling accesslog DIT, maybe others by admin in the conf editor
-    wlogger.log(tid, "Checking existing data and schema folders for LDAP")
-    conf = open(conffile, 'r')
-    for line in conf:
-        if re.match('^directory', line):
-            folder = line.split()[1]
-            if not c.exists(os.path.join(chdir, folder)):
+    with step(tid, "Data directories"):
+        wlogger.log(tid, "Checking existing data and schema folders for LDAP")
+        folders = data_directories(conffile)
+        paths = c.exists_many([chdir + folder for folder in folders])
+        for folder in folders:
+            if not paths[chdir + folder].exists:
                 run_command(tid, c, 'mkdir -p '+folder, chdir)
             else:
                 wlogger.log(tid, folder, 'success')
@@ -251,57 +479,64 @@ def configure_gluu_server(self, server_id, conffile):
     # 5. Gluu Schema file will be present - no checks required
 
     # 6. Copy User's custom schema files if any
-    schemas = os.listdir(app.config['SCHEMA_DIR'])
-    if len(schemas):
-        wlogger.log(tid, "Copying custom schema files to the server")
-        for schema in schemas:
-            local = os.path.join(app.config['SCHEMA_DIR'], schema)
-            remote = chdir+"/opt/gluu/schema/openldap/"+schema
-            upload_file(tid, c, local, remote)
+    with step(tid, "Schema files"):
+        schemas = schema_files(app.config['SCHEMA_DIR'])
+        if len(schemas):
+            wlogger.log(tid, "Copying custom schema files to the server")
+            sync_files(tid, c, schemas, chdir+"/opt/gluu/schema/openldap")
 
     # 7. Copy the slapd.conf
-    wlogger.log(tid, "Copying slapd.conf file to the server")
-    upload_file(tid, c, conffile, chdir+"/opt/symas/etc/openaldap/slapd.conf")
-
-    wlogger.log(tid, "Restarting LDAP server to validate slapd.conf")
-    # IMPORTANT:
-    # Restart allows the server to create the mdb files for accesslog so
-    # slaptest doesn't throw errors during OLC generation
-    run_command(tid, c, 'service solserver restart', chdir)
+    with step(tid, "slapd.conf upload"):
+        wlogger.log(tid, "Copying slapd.conf file to the server")
+        sync_files(tid, c, {'slapd.conf': conffile},
+                   chdir+"/opt/symas/etc/openldap")
+
+    with step(tid, "Restart"):
+        wlogger.log(tid, "Restarting LDAP server to validate slapd.conf")
+        # IMPORTANT:
+        # Restart allows the server to create the mdb files for accesslog so
+        # slaptest doesn't throw errors during OLC generation
+        run_command(tid, c, 'service solserver restart', chdir)
 
     # 8. Download openldap.crt to be used in other servers for ldaps
-    wlogger.log(tid, "Downloading SSL Certificate to be used in other servers")
-    remote = chdir + '/etc/certs/openldap.crt'
-    local = os.path.join(app.config["CERTS_DIR"],
-                         "{0}.crt".format(server.hostname))
-    download_file(tid, c, remote, local)
+    with step(tid, "Certificate download"):
+        wlogger.log(tid, "Downloading SSL Certificate to be used in other "
+                    "servers")
+        remote = chdir + '/etc/certs/openldap.crt'
+        local = os.path.join(app.config["CERTS_DIR"],
+                             "{0}.crt".format(server.hostname))
+        download_file(tid, c, remote, local)
 
     # 9. Generate OLC slapd.d
-    wlogger.log(tid, "Convert slapd.conf to slapd.d OLC")
-    run_command(tid, c, 'service solserver stop', chdir)
-    run_command(tid, c, "rm -rf /opt/symas/etc/openldap/slapd.d", chdir)
-    run_command(tid, c, "mkdir /opt/symas/etc/openldap/slapd.d", chdir)
-    run_command(tid, c, "/opt/symas/bin/slaptest -f /opt/symas/etc/openldap/"
-                "slapd.conf -F /opt/symas/etc/openldap/slapd.d", chdir)
+    with step(tid, "OLC conversion"):
+        wlogger.log(tid, "Convert slapd.conf to slapd.d OLC")
+        run_command(tid, c, 'service solserver stop', chdir)
+        run_command(tid, c, "rm -rf /opt/symas/etc/openldap/slapd.d", chdir)
+        run_command(tid, c, "mkdir /opt/symas/etc/openldap/slapd.d", chdir)
+        run_command(tid, c, "/opt/symas/bin/slaptest -f /opt/symas/etc/"
+                    "openldap/slapd.conf -F /opt/symas/etc/openldap/slapd.d",
+                    chdir, stream=True)
 
     # 10. Reset ownerships
-    run_command(tid, c, "chown -R ldap:ldap /opt/gluu/data", chdir)
-    run_command(tid, c, "chown -R ldap:ldap /opt/gluu/schema/openldap", chdir)
-    run_command(tid, c, "chown -R ldap:ldap /opt/symas/etc/openldap/slapd.d",
-                chdir)
+    with step(tid, "chown"):
+        run_command(tid, c, "chown -R ldap:ldap /opt/gluu/data", chdir)
+        run_command(tid, c, "chown -R ldap:ldap /opt/gluu/schema/openldap",
+                    chdir)
+        run_command(tid, c,
+                    "chown -R ldap:ldap /opt/symas/etc/openldap/slapd.d",
+                    chdir)
 
     # 11. Restart the solserver with the new OLC configuration
-    wlogger.log(tid, "Restarting LDAP server with OLC configuration")
-    log = run_command(tid, c, "service solserver start", chdir)
-    if 'failed' in log:
-        wlogger.log(tid, "There seems to be some issue in starting the server."
-                    "Running LDAP server in debug mode for troubleshooting")
-        run_command(tid, c, "service solserver start -d 1", chdir)
-
-    # Everything is done. Set the flag to based on the messages
-    msgs = wlogger.get_messages(tid)
-    setup_success = True
-    for msg in msgs:
-        setup_success = setup_success and msg['level'] != 'error'
-    server.setup = setup_success
+    with step(tid, "Final start"):
+        wlogger.log(tid, "Restarting LDAP server with OLC configuration")
+        log = run_command(tid, c, "service solserver start", chdir)
+        if 'failed' in log:
+            wlogger.log(tid, "There seems to be some issue in starting the "
+                        "server. Running LDAP server in debug mode for "
+                        "troubleshooting")
+            run_command(tid, c, "service solserver start -d 1", chdir,
+                        stream=True, timeout=DEBUG_TIMEOUT)
+
+    # Everything is done. Set the flag based on the errors logged
+    server.setup = not wlogger.get_summary(tid)['counts'].get('error')
     db.session.commit()
@@ -0,0 +1,483 @@
+"""Periodic tasks keeping track of the state of the servers in the cluster.
+"""
+import calendar
+import json
+import socket
+import time
+from datetime import datetime
+
+import ldap
+import redis
+from sqlalchemy.exc import SQLAlchemyError
+
+from clustermgr.extensions import celery, db
+from clustermgr.models import LDAPServer, ReplicationStatus, OxauthServer, \
+    ServerHealth, MonitorSample, MetricSeries
+from clustermgr.core.ldaplib import ldap_conn, get_context_csn, parse_csn, \
+    count_entries, bind_time
+from clustermgr.core.fanout import parallel_map
+from clustermgr.core.remote import pool as remote_pool
+
+ROOTDN = "cn=directory manager,o=gluu"
+
+# statistics of the MDB databases published in cn=monitor
+MDB_ATTRS = {
+    'olmmdbpagesmax': 'pages_max',
+    'olmmdbpagesused': 'pages_used',
+    'olmmdbpagesfree': 'pages_free',
+    'olmmdbreadersmax': 'readers_max',
+    'olmmdbreadersused': 'readers_used',
+    'olmmdbentries': 'entries',
+}
+
+# redis list of the samples waiting to be added to MetricSeries, capped to
+# the latest SAMPLES_MAX ones, and the lock of the task adding them
+SAMPLES_KEY = 'metric_series:samples'
+SAMPLES_LOCK = 'metric_series:flush'
+SAMPLES_MAX = 100000
+
+_redis = None
+
+# cn=monitor values and rates whose history is kept in MetricSeries
+MONITOR_SERIES = ('ops.all.completed', 'ops.search.completed',
+                  'ops.modify.completed', 'connections.current',
+                  'threads.active', 'waiters.read')
+
+
+def starttls(server):
+    return server.protocol == 'starttls'
+
+
+def read_context_csn(server):
+    """Reads the contextCSN values of the o=gluu suffix of a server.
+    """
+    with ldap_conn(server.hostname, server.port, ROOTDN, server.admin_pw,
+                   starttls(server)) as con:
+        return get_context_csn(con, celery.conf["BASE_DN"])
+
+
+def compute_lag(provider_csns, consumer_csns):
+    """Compares the contextCSN values of a provider and one of its consumers
+    server ID by server ID.
+
+    Args:
+        provider_csns (dict): server ID to CSN map of the provider
+        consumer_csns (dict): server ID to CSN map of the consumer
+
+    Returns:
+        tuple of the lag in seconds and the oldest consumer CSN which is
+        behind the provider. The CSN is None when the consumer is up to date.
+        The lag is None when the consumer has no CSN for one of the servers.
+    """
+    lag = 0.0
+    behind = None
+    for sid, pcsn in provider_csns.iteritems():
+        ccsn = consumer_csns.get(sid)
+        if ccsn is None:
+            return None, None
+        ptime = parse_csn(pcsn)[0]
+        ctime = parse_csn(ccsn)[0]
+        if ptime > ctime:
+            lag = max(lag, ptime - ctime)
+            if behind is None or ccsn < behind:
+                behind = ccsn
+    return lag, behind
+
+
+def count_pending_changes(provider, csn):
+    """Counts the successful writes logged in the accesslog of the provider
+    since the given CSN.
+    """
+    stamp = csn.split("#")[0]
+    with ldap_conn(provider.hostname, provider.port, ROOTDN,
+                   provider.admin_pw, starttls(provider)) as con:
+        return count_entries(
+            con, "cn=accesslog",
+            "(&(objectClass=auditWriteObject)(reqResult=0)"
+            "(reqStart>={0}))".format(stamp))
+
+
+@celery.task
+def check_replication_lag():
+    """Reads the contextCSN of every provider and consumer in parallel and
+    stores the lag of each consumer in a :class:`ReplicationStatus` row. No
+    test entry is written to the servers.
+    """
+    max_workers = celery.conf["FANOUT_MAX_WORKERS"]
+    consumers = [c for c in LDAPServer.query.filter_by(role="consumer")
+                 if c.provider]
+    providers = dict((c.provider.id, c.provider) for c in consumers).values()
+    servers = providers + consumers
+
+    csns = {}
+    for server, (value, err, _) in zip(
+            servers, parallel_map(read_context_csn, servers, max_workers)):
+        csns[server.id] = (value, err)
+
+    checks = []
+    for consumer in consumers:
+        status = consumer.replication_status or ReplicationStatus()
+        status.consumer = consumer
+        status.checked_at = datetime.utcnow()
+        status.lag = status.pending_changes = None
+        status.provider_csn = status.consumer_csn = status.error = None
+
+        pcsns, perr = csns[consumer.provider.id]
+        ccsns, cerr = csns[consumer.id]
+        if perr or cerr:
+            status.error = "{0}".format(perr or cerr)
+        else:
+            status.provider_csn = max(pcsns.values()) if pcsns else None
+            status.consumer_csn = max(ccsns.values()) if ccsns else None
+            status.lag, behind = compute_lag(pcsns, ccsns)
+            if status.lag is None:
+                status.error = "Consumer has not received changes from all " \
+                    "the servers"
+            elif behind:
+                checks.append((status, consumer.provider, behind))
+            else:
+                status.pending_changes = 0
+        db.session.add(status)
+
+    results = parallel_map(lambda check: count_pending_changes(*check[1:]),
+                           checks, max_workers)
+    for (status, _, _), (count, err, _) in zip(checks, results):
+        if isinstance(err, ldap.NO_SUCH_OBJECT):
+            # provider has no accesslog database
+            continue
+        elif err:
+            status.error = "{0}".format(err)
+        else:
+            status.pending_changes = count
+
+    for consumer in consumers:
+        status = consumer.replication_status
+        record_sample(consumer.hostname, 'replication.lag', status.lag,
+                      status.checked_at)
+        record_sample(consumer.hostname, 'replication.pending_changes',
+                      status.pending_changes, status.checked_at)
+    db.session.commit()
+
+
+def connect_time(hostname, port, timeout):
+    """Returns the time in seconds taken to open a TCP connection.
+    """
+    start = time.time()
+    sock = socket.create_connection((hostname, port), timeout)
+    elapsed = time.time() - start
+    sock.close()
+    return elapsed
+
+
+def solserver_status(c, container=None):
+    """Returns the status of the solserver service, ``running`` or
+    ``stopped``, using the connected :class:`RemoteClient` c.
+    """
+    command = "service solserver status > /dev/null 2>&1 && echo running " \
+        "|| echo stopped"
+    if container:
+        command = 'chroot {0} /bin/bash -c "{1}"'.format(container, command)
+    return c.run(command)[1].strip()
+
+
+def probe(server_type, server, timeout):
+    """Runs the health checks of a server. A failed check doesn't stop the
+    following ones, its error is recorded in the result.
+
+    Args:
+        server_type (string): ``ldap`` or ``oxauth``
+        server: the :class:`LDAPServer` or :class:`OxauthServer` to probe
+        timeout (int): timeout of the TCP and SSH connections in seconds
+
+    Returns:
+        a new :class:`ServerHealth` object holding the results
+    """
+    check = ServerHealth(server_type=server_type, server_id=server.id,
+                         hostname=server.hostname,
+                         checked_at=datetime.utcnow())
+    errors = []
+    port = server.port if server_type == 'ldap' else 443
+    try:
+        check.connect_time = connect_time(server.hostname, port, timeout)
+    except socket.error as e:
+        errors.append("Port {0} unreachable: {1}".format(port, e))
+
+    if server_type == 'ldap' and check.connect_time is not None:
+        try:
+            check.bind_time = bind_time(server.hostname, server.port, ROOTDN,
+                                        server.admin_pw, starttls(server))
+        except ldap.LDAPError as e:
+            errors.append("LDAP bind failed: {0}".format(e))
+
+    container = None
+    if server.gluu_server:
+        container = '/opt/gluu-server-{0}'.format(server.gluu_version)
+    try:
+        with remote_pool.borrow(server.hostname, timeout=timeout) as c:
+            check.ssh = True
+            if server_type == 'ldap':
+                check.solserver = solserver_status(c, container)
+    except Exception as e:
+        errors.append("SSH check failed: {0}".format(e))
+    if check.ssh is None:
+        check.ssh = False
+    if check.solserver == 'stopped':
+        errors.append("solserver is not running")
+
+    check.error = "\n".join(errors) or None
+    return check
+
+
+@celery.task
+def check_server_health():
+    """Probes every LDAP and oxAuth server in parallel and stores the results
+    as :class:`ServerHealth` rows. Only the latest HEALTH_HISTORY probes of
+    each server are kept, so the dashboard can show the health of the cluster
+    without reaching the servers.
+    """
+    timeout = celery.conf["HEALTH_CHECK_TIMEOUT"]
+    history = celery.conf["HEALTH_HISTORY"]
+    targets = [('ldap', s) for s in LDAPServer.query] + \
+        [('oxauth', s) for s in OxauthServer.query]
+
+    results = parallel_map(lambda target: probe(target[0], target[1],
+                                                timeout),
+                           targets, celery.conf["FANOUT_MAX_WORKERS"])
+    for (server_type, server), (check, err, _) in zip(targets, results):
+        if err:
+            check = ServerHealth(server_type=server_type, server_id=server.id,
+                                 hostname=server.hostname,
+                                 checked_at=datetime.utcnow(),
+                                 error="{0}".format(err))
+        db.session.add(check)
+        record_sample(check.hostname, 'health.connect_time',
+                      check.connect_time, check.checked_at)
+        record_sample(check.hostname, 'health.bind_time', check.bind_time,
+                      check.checked_at)
+    db.session.flush()
+
+    # drop the old probes and the ones of the servers which were removed
+    for server_type, model in (('ldap', LDAPServer), ('oxauth', OxauthServer)):
+        ids = [s.id for t, s in targets if t == server_type]
+        stale = ServerHealth.query.filter_by(server_type=server_type)
+        if ids:
+            stale = stale.filter(~ServerHealth.server_id.in_(ids))
+        stale.delete(synchronize_session=False)
+        for server_id in ids:
+            old = ServerHealth.query.filter_by(
+                server_type=server_type, server_id=server_id).order_by(
+                ServerHealth.checked_at.desc()).offset(history)
+            for check in old:
+                db.session.delete(check)
+    db.session.commit()
+
+
+def _monitor_entries(con, base, attrs, scope=ldap.SCOPE_ONELEVEL,
+                     filterstr="(objectClass=*)"):
+    """Searches cn=monitor and yields the value of the first RDN of each
+    entry, lowercased and with underscores for the spaces, with its
+    attributes keyed by their lowercased names.
+    """
+    for dn, entry in con.search_s(base, scope, filterstr, attrs):
+        name = dn.split(",")[0].split("=", 1)[1].strip().lower()
+        name = name.replace(" ", "_")
+        yield name, dict((k.lower(), v) for k, v in entry.iteritems())
+
+
+def _number(values):
+    try:
+        return int(values[0])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def read_monitor(server):
+    """Reads the operation, connection, thread, waiter and MDB statistics
+    of a server from its cn=monitor backend.
+
+    Returns:
+        dict of the metric names like ``ops.search.completed``,
+        ``connections.current``, ``threads.active``, ``waiters.read`` or
+        ``mdb.o=gluu.pages_used`` to their values
+    """
+    sample = {}
+    with ldap_conn(server.hostname, server.port, ROOTDN, server.admin_pw,
+                   starttls(server)) as con:
+        for name, entry in _monitor_entries(
+                con, "cn=Operations,cn=Monitor",
+                ["monitorOpInitiated", "monitorOpCompleted"],
+                ldap.SCOPE_SUBTREE):
+            if name == "operations":
+                name = "all"
+            for attr in ("initiated", "completed"):
+                value = _number(entry.get("monitorop" + attr))
+                if value is not None:
+                    sample["ops.{0}.{1}".format(name, attr)] = value
+
+        for group, attr in (("connections", "monitorcounter"),
+                            ("threads", "monitoredinfo"),
+                            ("waiters", "monitorcounter")):
+            for name, entry in _monitor_entries(
+                    con, "cn={0},cn=Monitor".format(group.title()),
+                    [attr]):
+                value = _number(entry.get(attr))
+                # skips the per connection entries and the textual infos
+                if value is not None and not name.startswith("connection"):
+                    sample["{0}.{1}".format(group, name)] = value
+
+        for _, entry in _monitor_entries(
+                con, "cn=Databases,cn=Monitor",
+                ["namingContexts"] + MDB_ATTRS.keys(),
+                filterstr="(objectClass=olmMDBDatabase)"):
+            suffix = entry.get("namingcontexts", ["unknown"])[0].lower()
+            for attr, metric in MDB_ATTRS.iteritems():
+                value = _number(entry.get(attr))
+                if value is not None:
+                    sample["mdb.{0}.{1}".format(suffix, metric)] = value
+    return sample
+
+
+def is_monitor_counter(metric):
+    """Tells whether the metric is a counter, which only increases while
+    slapd runs, rather than a gauge.
+    """
+    return metric.startswith("ops.") or metric == "connections.total"
+
+
+def compute_rates(previous, current, elapsed):
+    """Computes the per second rates of the counters between two samples.
+
+    Args:
+        previous (dict): the older sample returned by read_monitor()
+        current (dict): the newer sample
+        elapsed (float): seconds between the two samples
+
+    Returns:
+        dict of the counters to their rates. Counters which went down, as
+        after a restart of slapd, and counters missing from the older
+        sample are left out.
+    """
+    rates = {}
+    if elapsed <= 0:
+        return rates
+    for metric, value in current.iteritems():
+        if not is_monitor_counter(metric) or metric not in previous:
+            continue
+        delta = value - previous[metric]
+        if delta >= 0:
+            rates[metric] = delta / float(elapsed)
+    return rates
+
+
+@celery.task
+def collect_monitor_metrics():
+    """Reads cn=monitor from every LDAP server in parallel and stores the
+    values along with their rates since the previous collection in the
+    :class:`MonitorSample` of the server.
+    """
+    servers = LDAPServer.query.all()
+    results = parallel_map(read_monitor, servers,
+                           celery.conf["FANOUT_MAX_WORKERS"])
+    now = datetime.utcnow()
+    for server, (values, err, _) in zip(servers, results):
+        sample = server.monitor_sample or MonitorSample(server=server)
+        if err:
+            sample.error = "{0}".format(err)
+            db.session.add(sample)
+            continue
+        rates = {}
+        if sample.counters and sample.sampled_at:
+            rates = compute_rates(sample.counter_values, values,
+                                  (now - sample.sampled_at).total_seconds())
+        sample.counters = json.dumps(values)
+        sample.rates = json.dumps(rates)
+        sample.error = None
+        sample.sampled_at = now
+        db.session.add(sample)
+        for metric in MONITOR_SERIES:
+            # counters are recorded as rates, gauges as they are
+            value = rates.get(metric) if is_monitor_counter(metric) \
+                else values.get(metric)
+            record_sample(server.hostname, 'monitor.' + metric, value, now)
+    db.session.commit()
+
+
+def _samples_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis(host=celery.conf["REDIS_HOST"],
+                             port=celery.conf["REDIS_PORT"],
+                             db=celery.conf["REDIS_LOG_DB"])
+    return _redis
+
+
+def record_sample(server, metric, value, timestamp=None):
+    """Queues a point of the history of a metric. The points are added to
+    the MetricSeries rows by :func:`flush_metric_series`, the only writer of
+    the series, so concurrent tasks don't overwrite each other's points.
+
+    Args:
+        server (string): hostname of the server the metric is about
+        metric (string): name of the metric
+        value (float): the value, None values are ignored
+        timestamp (datetime, optional): time of the value. Defaults to now
+    """
+    if value is None:
+        return
+    timestamp = timestamp or datetime.utcnow()
+    sample = json.dumps([server, metric, value,
+                         calendar.timegm(timestamp.utctimetuple())])
+    pipe = _samples_redis().pipeline(transaction=False)
+    pipe.rpush(SAMPLES_KEY, sample)
+    pipe.ltrim(SAMPLES_KEY, -SAMPLES_MAX, -1)
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        # the history is not worth failing the task for
+        pass
+
+
+@celery.task
+def flush_metric_series():
+    """Adds the samples queued by record_sample() to the MetricSeries rows,
+    loading and storing each series once. The samples are put back in the
+    queue when they can't be saved.
+    """
+    r = _samples_redis()
+    if not r.set(SAMPLES_LOCK, 1, nx=True, ex=300):
+        # the previous run is still going
+        return
+    try:
+        pipe = r.pipeline()
+        pipe.lrange(SAMPLES_KEY, 0, -1)
+        pipe.delete(SAMPLES_KEY)
+        queued = pipe.execute()[0]
+        if not queued:
+            return
+
+        points = {}
+        for item in queued:
+            server, metric, value, timestamp = json.loads(item)
+            points.setdefault((server, metric), []).append((timestamp, value))
+        try:
+            for (server, metric), values in points.iteritems():
+                MetricSeries.add_points(server, metric, sorted(values))
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            r.lpush(SAMPLES_KEY, *reversed(queued))
+            raise
+    finally:
+        r.delete(SAMPLES_LOCK)
+
+
+def record_task_duration(name, duration):
+    """Queues the duration of a task run as a point of the
+    ``task.<name>.duration`` history of the manager.
+
+    Args:
+        name (string): the full name of the task
+        duration (float): the run time in seconds
+    """
+    record_sample('manager', 'task.{0}.duration'.format(
+        name.rsplit('.', 1)[-1]), duration)
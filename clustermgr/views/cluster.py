@@ -159,6 +159,10 @@ def ldif_upload(server_id):
         f = form.ldif.data
         filename = "{0}_{1}".format(server_id, 'init.ldif')
         f.save(os.path.join(app.config['LDIF_DIR'], filename))
+        if form.fast_load.data:
+            return redirect(url_for('cluster.initialize', server_id=server_id,
+                                    ldif=1, fast=1,
+                                    threads=form.tool_threads.data))
         return redirect(url_for('cluster.initialize', server_id=server_id)+"?ldif=1")
     return render_template('ldif_upload.html', form=form)
 
@@ -179,6 +183,8 @@ def initialize(server_id):
     and adds the replicator account to the o=gluu suffix."""
     server = LDAPServer.query.get(server_id)
     use_ldif = bool(request.args.get('ldif', 0))
+    fast_load = bool(request.args.get('fast', 0))
+    tool_threads = request.args.get('threads', None, type=int)
     if not server:
         return redirect(url_for('error', error='invalid-id-for-init'))
     if server.role != 'provider':
@@ -186,7 +192,8 @@ def initialize(server_id):
               "provider. Nothing done." % server.hostname, "warning")
         return redirect(url_for('home'))
 
-    task = initialize_provider.delay(server_id, use_ldif)
+    task = initialize_provider.delay(server_id, use_ldif, fast_load,
+                                     tool_threads)
     head = "Initializing server"
     return render_template('logger.html', heading=head, server=server,
                            task=task)
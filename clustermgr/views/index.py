@@ -1,14 +1,18 @@
 import os
+import json
+import time
 
 from flask import Blueprint, render_template, redirect, url_for, flash, \
-        request, jsonify
+        request, jsonify, Response, stream_with_context, abort
 from flask import current_app as app
 from werkzeug.utils import secure_filename
 from celery.result import AsyncResult
+from sqlalchemy.orm import joinedload
 
 from clustermgr.extensions import db, wlogger, celery
 from clustermgr.models import LDAPServer, AppConfiguration, KeyRotation, \
-    OxauthServer
+    OxauthServer, ReplicationStatus, ServerHealth, MonitorSample, \
+    MetricSeries, SetupStep
 from clustermgr.forms import AppConfigForm, KeyRotationForm, SchemaForm
 from clustermgr.tasks.all import rotate_pub_keys
 from clustermgr.core.utils import encrypt_text
@@ -20,7 +24,10 @@ index = Blueprint('index', __name__)
 
 @index.route('/')
 def home():
-    servers = LDAPServer.query.all()
+    # the dashboard shows the replication status and the monitor sample of
+    # every server, loaded along instead of one query per server
+    servers = LDAPServer.query.options(
+        joinedload('replication_status'), joinedload('monitor_sample')).all()
     config = AppConfiguration.query.first()
     if len(servers) == 0:
         return render_template('intro.html')
@@ -32,8 +39,11 @@ def home():
         elif server.role == 'consumer':
             data["consumer"] += 1
 
+    # health of the servers as last probed by check_server_health
     return render_template('dashboard.html', data=data, servers=servers,
-                           conf=config)
+                           conf=config, health=ServerHealth.latest('ldap'),
+                           oxauth_servers=OxauthServer.query.all(),
+                           oxauth_health=ServerHealth.latest('oxauth'))
 
 
 @index.route('/configuration/', methods=['GET', 'POST'])
@@ -170,11 +180,109 @@ def delete_oxauth_server(id):
     return jsonify({}), 204
 
 
+@index.route("/api/replication_lag")
+def replication_lag():
+    return jsonify([status.to_dict() for status in ReplicationStatus.query])
+
+
+@index.route("/api/monitor")
+def monitor_metrics():
+    return jsonify([sample.to_dict() for sample in MonitorSample.query])
+
+
+@index.route("/api/series")
+def metric_series():
+    """Lists the metrics having a history or, when the ``server`` and
+    ``metric`` arguments are given, returns the points of the metric between
+    the ``start`` and ``end`` unix times averaged into at most ``points``
+    values. The last day is returned by default.
+    """
+    server = request.args.get('server')
+    metric = request.args.get('metric')
+    if not server or not metric:
+        rows = db.session.query(MetricSeries.server, MetricSeries.metric)
+        return jsonify([{"server": row.server, "metric": row.metric}
+                        for row in rows])
+
+    series = MetricSeries.query.filter_by(server=server,
+                                          metric=metric).first_or_404()
+    end = request.args.get('end', int(time.time()), type=int)
+    start = request.args.get('start', end - 86400, type=int)
+    resolution, points = series.series.query(
+        start, end, request.args.get('points', 300, type=int))
+    return jsonify({"server": server, "metric": metric,
+                    "resolution": resolution, "points": points})
+
+
+@index.route("/api/server_health")
+def server_health():
+    checks = ServerHealth.latest('ldap').values() + \
+        ServerHealth.latest('oxauth').values()
+    return jsonify([check.to_dict() for check in checks])
+
+
+@index.route("/api/server/<int:server_id>/setup_steps")
+def setup_steps(server_id):
+    """Returns the timings of the steps and commands of the last setup of
+    the server.
+    """
+    steps = SetupStep.query.filter_by(server_id=server_id).order_by(
+        SetupStep.started_at)
+    return jsonify([step.to_dict() for step in steps])
+
+
 @index.route('/log/<task_id>')
 def get_log(task_id):
-    msgs = wlogger.get_messages(task_id)
+    since = request.args.get('since', 0, type=int)
+    msgs, cursor = wlogger.read(task_id, since)
     result = AsyncResult(id=task_id, app=celery)
-    if result.state == 'SUCCESS' or result.state == 'FAILED':
+    if result.state == 'SUCCESS' or result.state == 'FAILURE':
         wlogger.clean(task_id)
-    log = {'task_id': task_id, 'state': result.state, 'messages': msgs}
+    log = {'task_id': task_id, 'state': result.state, 'messages': msgs,
+           'cursor': cursor}
     return jsonify(log)
+
+
+@index.route('/log/<task_id>/stream')
+def stream_log(task_id):
+    """Streams the log messages and the final state of the task as
+    Server-Sent Events. A reconnecting browser resumes from the id of the
+    last event it has received.
+
+    The stream holds the worker serving it until the task ends, so it is
+    only available when LOG_STREAMING is enabled.
+    """
+    if not app.config.get('LOG_STREAMING'):
+        abort(404)
+
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+
+    def event(name, data, cursor=None):
+        head = 'id: {0}\n'.format(cursor) if cursor is not None else ''
+        return '{0}event: {1}\ndata: {2}\n\n'.format(head, name,
+                                                       json.dumps(data))
+
+    def events():
+        # a task which has already ended won't publish its end any more
+        state = AsyncResult(id=task_id, app=celery).state
+        done = state in ('SUCCESS', 'FAILURE')
+        for msgs, cursor, end in wlogger.follow(task_id, since):
+            if msgs:
+                yield event('log', msgs, cursor)
+            if not msgs and not end:
+                # nothing happened for a while, the worker might be gone
+                state = AsyncResult(id=task_id, app=celery).state
+                done = state in ('SUCCESS', 'FAILURE')
+                if not done:
+                    yield ': keepalive\n\n'
+            if end or done:
+                wlogger.clean(task_id)
+                yield event('end', {'state': end or state})
+                return
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
@@ -9,10 +9,25 @@ from clustermgr.extensions import db
 from clustermgr.models import LoggingServer
 from clustermgr.forms import LoggingServerForm
 from clustermgr.core.msgcon import get_audit_logs, get_server_logs, \
-    get_server_log_item, get_audit_log_item, LogCollection, LogItem
+    get_server_log_item, get_audit_log_item, LogCollection, LogItem, \
+    prefetch, keyset_supported
 
 logserver = Blueprint('logserver', __name__, template_folder='templates')
 
+#: largest number of logs shown in a page
+MAX_PAGE_SIZE = 100
+
+
+def page_args():
+    """Returns the before and after cursors, the page size and the page
+    number requested in the query string.
+    """
+    size = request.args.get("size", 20, type=int)
+    return (request.args.get("before", type=int),
+            request.args.get("after", type=int),
+            min(max(size, 1), MAX_PAGE_SIZE),
+            max(request.args.get("page", 0, type=int), 0))
+
 
 @logserver.route("/", methods=["GET", "POST"])
 def logging_server():
@@ -37,20 +52,32 @@ def oxauth_server_log():
     err = ""
     logs = None
     server = LoggingServer.query.first()
-    page = request.args.get("page", 0)
+    before, after, size, page = page_args()
 
     if not server:
         err = "Missing logging server configuration."
         return render_template("oxauth_server_log.html", logs=logs, err=err)
 
     try:
-        data, status_code = get_server_logs(server.url, page)
-        logs = LogCollection("oxauth-server-logs", data)
+        data, status_code = get_server_logs(server.url, before, after, size,
+                                            page)
+        if not keyset_supported(server.url):
+            # the logs came by page number, newest first
+            before = after = None
+        logs = LogCollection("oxauth-server-logs", data, size, before, after,
+                             page)
         if not logs.has_logs():
             err = "Logs are not available at the moment. Please try again."
+        elif logs.has_next:
+            # the older logs are usually requested next
+            prefetch(get_server_logs, server.url, logs.next_cursor, None,
+                     size, page + 1)
     except requests.exceptions.ConnectionError:
         err = "Unable to establish connection to logging server. " \
               "Please check the connection URL."
+    except requests.exceptions.Timeout:
+        err = "The logging server took too long to respond. " \
+              "Please try again."
     return render_template("oxauth_server_log.html", logs=logs, err=err)
 
 
@@ -59,20 +86,32 @@ def oxauth_audit_log():
     err = ""
     logs = None
     server = LoggingServer.query.first()
-    page = request.args.get("page", 0)
+    before, after, size, page = page_args()
 
     if not server:
         err = "Missing logging server configuration."
         return render_template("oxauth_audit_log.html", logs=logs, err=err)
 
     try:
-        data, status_code = get_audit_logs(server.url, page)
-        logs = LogCollection("oauth2-audit-logs", data)
+        data, status_code = get_audit_logs(server.url, before, after, size,
+                                            page)
+        if not keyset_supported(server.url):
+            # the logs came by page number, newest first
+            before = after = None
+        logs = LogCollection("oauth2-audit-logs", data, size, before, after,
+                             page)
         if not logs.has_logs():
             err = "Logs are not available at the moment. Please try again."
+        elif logs.has_next:
+            # the older logs are usually requested next
+            prefetch(get_audit_logs, server.url, logs.next_cursor, None,
+                     size, page + 1)
     except requests.exceptions.ConnectionError:
         err = "Unable to establish connection to logging server. " \
               "Please check the connection URL."
+    except requests.exceptions.Timeout:
+        err = "The logging server took too long to respond. " \
+              "Please try again."
     return render_template("oxauth_audit_log.html", logs=logs, err=err)
 
 
@@ -95,6 +134,9 @@ def audit_log_item(id):
     except requests.exceptions.ConnectionError:
         err = "Unable to establish connection to logging server. " \
               "Please check the connection URL."
+    except requests.exceptions.Timeout:
+        err = "The logging server took too long to respond. " \
+              "Please try again."
     return render_template("view_audit_log.html", log=log, err=err)
 
 
@@ -117,4 +159,7 @@ def server_log_item(id):
     except requests.exceptions.ConnectionError:
         err = "Unable to establish connection to logging server. " \
               "Please check the connection URL."
+    except requests.exceptions.Timeout:
+        err = "The logging server took too long to respond. " \
+              "Please try again."
     return render_template("view_server_log.html", log=log, err=err)
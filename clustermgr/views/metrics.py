@@ -0,0 +1,14 @@
+from flask import Blueprint, Response
+
+from clustermgr.extensions import metrics as registry
+
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.route('/metrics')
+def expose():
+    """Exposes the runtime metrics of the web application and the workers
+    for Prometheus.
+    """
+    return Response(registry.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
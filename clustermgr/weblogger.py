@@ -3,6 +3,76 @@
 
 import redis
 import json
+import threading
+
+from .metrics import metrics
+
+
+MESSAGES = metrics.counter('clustermgr_weblogger_messages_total',
+                           'Messages written by WebLogger, by level')
+WRITES = metrics.counter('clustermgr_weblogger_writes_total',
+                         'Pipelined writes of WebLogger messages to Redis')
+STORAGE = metrics.gauge('clustermgr_weblogger_storage',
+                        'Tasks, Redis keys, entries and bytes held by '
+                        'WebLogger')
+
+
+# Appends the messages ARGV[4:] to the list KEYS[1] and drops the oldest ones
+# to keep at most ARGV[2] entries and ARGV[3] bytes. The number of dropped
+# entries and the bytes held are kept in the hash KEYS[2], and both keys
+# expire ARGV[1] seconds after the last write.
+APPEND_SCRIPT = """
+local size = 0
+for i = 4, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+    size = size + string.len(ARGV[i])
+end
+size = redis.call('HINCRBY', KEYS[2], 'bytes', size)
+local length = redis.call('LLEN', KEYS[1])
+local drop = length - tonumber(ARGV[2])
+if drop < 0 then
+    drop = 0
+end
+for i = 0, drop - 1 do
+    size = size - string.len(redis.call('LINDEX', KEYS[1], i))
+end
+while size > tonumber(ARGV[3]) and drop < length - 1 do
+    size = size - string.len(redis.call('LINDEX', KEYS[1], drop))
+    drop = drop + 1
+end
+if drop > 0 then
+    redis.call('LTRIM', KEYS[1], drop, -1)
+    redis.call('HINCRBY', KEYS[2], 'trimmed', drop)
+    redis.call('HSET', KEYS[2], 'bytes', size)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+"""
+
+# Returns the index of the first message at or after the cursor ARGV[1] still
+# held in the list KEYS[1], along with the messages from there.
+READ_SCRIPT = """
+local trimmed = tonumber(redis.call('HGET', KEYS[2], 'trimmed') or '0')
+local start = tonumber(ARGV[1]) - trimmed
+if start < 0 then
+    start = 0
+end
+return {trimmed + start, redis.call('LRANGE', KEYS[1], start, -1)}
+"""
+
+
+def split_key(prefix, key):
+    """Returns the task id and the kind, ``log`` or ``meta``, of a redis key
+    holding the log of a task, or None when the key is not one of them.
+    """
+    if not key.startswith(prefix + ':'):
+        return None
+    parts = key[len(prefix) + 1:].split(':')
+    if len(parts) == 1 and parts[0]:
+        return parts[0], 'log'
+    if len(parts) == 2 and parts[0] and parts[1] == 'meta':
+        return parts[0], 'meta'
+    return None
 
 
 class WebLogger(object):
@@ -24,6 +94,11 @@ class WebLogger(object):
         following values in the Flask application config:
         REDIS_HOST, REDIS_PORT, REDIS_LOG_DB
 
+        The buffering of the messages is tuned with WEBLOGGER_BUFFER_SIZE and
+        WEBLOGGER_FLUSH_INTERVAL. The log of a task expires WEBLOGGER_TTL
+        seconds after its last message and keeps only the latest
+        WEBLOGGER_MAX_ENTRIES messages within WEBLOGGER_MAX_BYTES.
+
     Initialization::
 
         from flask import Flask
@@ -45,16 +120,29 @@ class WebLogger(object):
     Logging:
         Refer log()
 
+    Buffering:
+        Refer start_buffering()
+
     Retrival:
-        Refer get_messages()
+        Refer get_messages(), follow() and get_summary()
 
     Cleanup:
-        Refer clean()
+        Refer clean() and stats()
     """
     def __init__(self, app=None):
         self.app = app
         self.r = redis.Redis()
         self.prefix = 'weblogger'
+        self.buffer_size = 50
+        self.flush_interval = 0.5
+        self.ttl = 86400
+        self.max_entries = 5000
+        self.max_bytes = 5 * 1024 * 1024
+        self._buffers = {}
+        self._timers = {}
+        self._lock = threading.RLock()
+        self._append = self.r.register_script(APPEND_SCRIPT)
+        self._read = self.r.register_script(READ_SCRIPT)
         if app is not None:
             self.init_app(app)
 
@@ -63,13 +151,29 @@ class WebLogger(object):
         port = app.config['REDIS_PORT']
         db = app.config['REDIS_LOG_DB']
         self.prefix = app.name
+        self.buffer_size = app.config.get('WEBLOGGER_BUFFER_SIZE', 50)
+        self.flush_interval = app.config.get('WEBLOGGER_FLUSH_INTERVAL', 0.5)
+        self.ttl = app.config.get('WEBLOGGER_TTL', 86400)
+        self.max_entries = app.config.get('WEBLOGGER_MAX_ENTRIES', 5000)
+        self.max_bytes = app.config.get('WEBLOGGER_MAX_BYTES',
+                                        5 * 1024 * 1024)
 
         self.r.connection_pool.disconnect()
         self.r = redis.Redis(host=host, port=port, db=db)
+        self._append = self.r.register_script(APPEND_SCRIPT)
+        self._read = self.r.register_script(READ_SCRIPT)
+        metrics.collector(self._collect)
+
+    def _collect(self):
+        return [(STORAGE, {'kind': kind}, value)
+                for kind, value in self.stats().iteritems()]
 
     def __key(self, taskid):
         return "{0}:{1}".format(self.prefix, taskid)
 
+    def __meta(self, taskid):
+        return "{0}:meta".format(self.__key(taskid))
+
     def log(self, taskid, message, level=None, **kwargs):
         """R Pushes the message into REDIS as a list for that task id with the key
         <app.name>:<taskid>.
@@ -96,22 +200,199 @@ class WebLogger(object):
         for k, v in kwargs.iteritems():
             logitem[k] = v
 
-        self.r.rpush(self.__key(taskid), json.dumps(logitem))
+        with self._lock:
+            if taskid in self._buffers:
+                self._buffers[taskid].append(logitem)
+                if len(self._buffers[taskid]) >= self.buffer_size:
+                    self.flush(taskid)
+                elif taskid not in self._timers:
+                    timer = threading.Timer(self.flush_interval, self.flush,
+                                            [taskid])
+                    timer.daemon = True
+                    self._timers[taskid] = timer
+                    timer.start()
+                return
 
-    def get_messages(self, taskid):
-        """Returns all the messages pushed by a task.
+        self._write(taskid, [logitem])
+
+    def _write(self, taskid, items):
+        """Writes the messages of a task to Redis in one pipeline, along with
+        the counters of their levels.
+        """
+        meta = self.__meta(taskid)
+        pipe = self.r.pipeline(transaction=False)
+        self._append(keys=[self.__key(taskid), meta],
+                     args=[self.ttl, self.max_entries, self.max_bytes] +
+                     [json.dumps(item) for item in items],
+                     client=pipe)
+        counts = {}
+        for item in items:
+            counts[item['level']] = counts.get(item['level'], 0) + 1
+        for level, count in counts.iteritems():
+            pipe.hincrby(meta, 'count:{0}'.format(level), count)
+            MESSAGES.inc(count, level=level)
+        WRITES.inc()
+        errors = [item for item in items if item['level'] == 'error']
+        if errors:
+            pipe.hsetnx(meta, 'first_error', json.dumps(errors[0]))
+        pipe.publish(self.__channel(taskid), json.dumps({'event': 'log'}))
+        pipe.execute()
+
+    def __channel(self, taskid):
+        return "{0}:events".format(self.__key(taskid))
+
+    def finish(self, taskid, state):
+        """Notifies the followers of the task that it has ended.
+
+        Args:
+            taskid (string) - the unique id of the task
+            state (string) - the final celery state of the task
+        """
+        self.r.publish(self.__channel(taskid),
+                       json.dumps({'event': 'end', 'state': state}))
+
+    def start_buffering(self, taskid):
+        """Buffers the messages of the task in memory instead of pushing each
+        of them to Redis. The buffer is flushed through a single pipeline
+        when it holds WEBLOGGER_BUFFER_SIZE messages, WEBLOGGER_FLUSH_INTERVAL
+        seconds after the first buffered message, and when stop_buffering()
+        is called at the end of the task. The order of the messages is kept.
+
+        Args:
+            taskid (string) - the unique id of the task
+        """
+        with self._lock:
+            self._buffers.setdefault(taskid, [])
+
+    def stop_buffering(self, taskid):
+        """Flushes the buffered messages of the task and logs its next
+        messages directly to Redis.
+
+        Args:
+            taskid (string) - the unique id of the task
+        """
+        with self._lock:
+            self.flush(taskid)
+            self._buffers.pop(taskid, None)
+
+    def flush(self, taskid):
+        """Pushes the buffered messages of the task to Redis.
+
+        Args:
+            taskid (string) - the unique id of the task
+        """
+        with self._lock:
+            timer = self._timers.pop(taskid, None)
+            if timer:
+                timer.cancel()
+            items = self._buffers.get(taskid)
+            if not items:
+                return
+            self._buffers[taskid] = []
+            # written while holding the lock so that the concurrent flushes
+            # of a task can't reorder its messages
+            self._write(taskid, items)
+
+    def read(self, taskid, since=0):
+        """Returns the messages pushed by a task after a cursor.
+
+        The cursor counts every message logged by the task, including the
+        ones already dropped to keep the log within its limits, so that it
+        stays valid when the oldest messages are trimmed.
+
+        Args:
+            taskid (string) - The unique id of the task
+            since (int) - cursor returned by the previous read, 0 to read
+                the log from its start
+
+        Returns:
+            tuple of (messages, cursor) with the list of message dicts and
+            the cursor to pass to the next read
+        """
+        self.flush(taskid)
+        first, messages = self._read(
+            keys=[self.__key(taskid), self.__meta(taskid)], args=[since])
+        messages = [json.loads(msg) for msg in messages]
+        return messages, first + len(messages)
+
+    def get_messages(self, taskid, since=0):
+        """Returns the messages pushed by a task.
+
+        Args:
+            taskid (string) - The unique id of the task
+            since (int) - cursor of the first message to return, see read()
+
+        Returns:
+            list of dicts containing the messages posted with the given
+            task id starting from the cursor ``since``
+        """
+        return self.read(taskid, since)[0]
+
+    def get_summary(self, taskid):
+        """Returns the number of messages logged by a task for each level
+        without reading its log. The counters include the messages trimmed
+        from the log.
 
         Args:
             taskid (string) - The unique id of the task
 
         Returns:
-            list of dicts containing all the messages posted with the given
-            task id
+            dict with the message ``counts`` by level, their ``total`` and
+            the ``first_error`` message dict, None when nothing was logged
+            with the error level
+        """
+        self.flush(taskid)
+        meta = self.r.hgetall(self.__meta(taskid))
+        counts = {}
+        for field, value in meta.iteritems():
+            if field.startswith('count:'):
+                counts[field[len('count:'):]] = int(value)
+        first_error = meta.get('first_error')
+        if first_error:
+            first_error = json.loads(first_error)
+        return {'counts': counts, 'total': sum(counts.values()),
+                'first_error': first_error}
+
+    def follow(self, taskid, since=0, timeout=15):
+        """Generator following the messages of a task as they are pushed.
+
+        The generator subscribes to the events of the task and reads the new
+        messages only when it is notified, so waiting doesn't cost any
+        request to Redis. It first yields the messages already logged after
+        ``since``, then one item for every batch of new messages, an empty
+        item every ``timeout`` seconds without any event, and stops after
+        the end of the task signalled by finish().
+
+        Args:
+            taskid (string) - the unique id of the task
+            since (int) - cursor of the first message to follow, see read()
+            timeout (int) - seconds to wait for an event before yielding an
+                empty item
+
+        Yields:
+            tuple of (messages, cursor, state) where cursor is the cursor
+            following the last message and state is the final state of the
+            task in the last item, None otherwise
         """
-        messages = self.r.lrange(self.__key(taskid), 0, -1)
-        if not messages:
-            return []
-        return [json.loads(msg) for msg in messages]
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.__channel(taskid))
+        try:
+            # subscribed before the first read, no message can be missed
+            # between the two
+            messages, since = self.read(taskid, since)
+            yield messages, since, None
+            while True:
+                event = pubsub.get_message(timeout=timeout)
+                if event is None:
+                    yield [], since, None
+                    continue
+                state = json.loads(event['data']).get('state')
+                messages, since = self.read(taskid, since)
+                yield messages, since, state
+                if state:
+                    return
+        finally:
+            pubsub.close()
 
     def clean(self, taskid):
         """Removes the log for the particular task id
@@ -119,4 +400,34 @@ class WebLogger(object):
         Args:
             taskid (string) - the unique id of the task
         """
-        self.r.delete(self.__key(taskid))
+        self.r.delete(self.__key(taskid), self.__meta(taskid))
+
+    def stats(self):
+        """Reports the storage used by the logs of all the tasks.
+
+        Returns:
+            dict with the number of ``tasks`` having a log, the number of
+            redis ``keys`` used, and the number of ``entries`` and ``bytes``
+            of the messages they hold
+        """
+        stats = {'tasks': 0, 'keys': 0, 'entries': 0, 'bytes': 0}
+        metas = []
+        for key in self.r.scan_iter(match="{0}:*".format(self.prefix),
+                                    count=500):
+            parsed = split_key(self.prefix, key)
+            if parsed is None:
+                continue
+            stats['keys'] += 1
+            if parsed[1] == 'meta':
+                metas.append(key)
+        for i in range(0, len(metas), 500):
+            pipe = self.r.pipeline(transaction=False)
+            for meta in metas[i:i+500]:
+                pipe.hget(meta, 'bytes')
+                pipe.llen(meta[:-len(':meta')])
+            values = pipe.execute()
+            for size, length in zip(values[::2], values[1::2]):
+                stats['tasks'] += 1
+                stats['bytes'] += int(size or 0)
+                stats['entries'] += length
+        return stats
@@ -0,0 +1,225 @@
+import time
+import unittest
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+from clustermgr.core import ldaplib
+from clustermgr.core.ldaplib import parse_csn, ldap_conn, paged_search, \
+    LDAPConnectionPool, SchemeCache
+
+
+class FakeConnection(object):
+    """Stands for a bound LDAPObject. Its operations raise SERVER_DOWN once
+    the connection is marked as down.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.down = False
+        self.unbound = False
+
+    def _check(self):
+        if self.down:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+    def bind_s(self, user, passwd):
+        self._check()
+
+    def start_tls_s(self):
+        self._check()
+
+    def whoami_s(self):
+        self._check()
+        return "dn:cn=directory manager,o=gluu"
+
+    def search_s(self, *args):
+        self._check()
+        return [("o=gluu", {"o": ["gluu"]})]
+
+    def unbind(self):
+        self.unbound = True
+
+    unbind_s = unbind
+
+
+class StubbedLDAPTest(unittest.TestCase):
+    """Replaces ldap.initialize with FakeConnection and gives ldaplib a new
+    pool and scheme cache.
+    """
+
+    def setUp(self):
+        self.connections = []
+        self.unreachable = set()
+        self._initialize = ldaplib.ldap.initialize
+        self._pool = ldaplib.pool
+        self._schemes = ldaplib.schemes
+        ldaplib.ldap.initialize = self.initialize
+        ldaplib.pool = LDAPConnectionPool()
+        ldaplib.schemes = SchemeCache()
+
+    def tearDown(self):
+        ldaplib.ldap.initialize = self._initialize
+        ldaplib.pool = self._pool
+        ldaplib.schemes = self._schemes
+
+    def initialize(self, uri):
+        conn = FakeConnection(uri)
+        conn.down = uri.split(":")[0] in self.unreachable
+        self.connections.append(conn)
+        return conn
+
+
+class LDAPConnectionPoolTest(StubbedLDAPTest):
+    def conn(self):
+        return ldap_conn("ldap.example.com", 1636, "cn=admin", "secret")
+
+    def test_connections_are_reused(self):
+        with self.conn() as conn:
+            conn.search_s("o=gluu", ldap.SCOPE_BASE)
+        with self.conn() as conn:
+            conn.search_s("o=gluu", ldap.SCOPE_BASE)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_connection_is_dropped_on_server_down(self):
+        with self.assertRaises(ldap.SERVER_DOWN):
+            with self.conn() as conn:
+                self.connections[0].down = True
+                conn.whoami_s()
+        self.assertTrue(self.connections[0].unbound)
+
+        with self.conn() as conn:
+            conn.search_s("o=gluu", ldap.SCOPE_BASE)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_dead_pooled_connection_is_retried_once(self):
+        with self.conn() as conn:
+            conn.search_s("o=gluu", ldap.SCOPE_BASE)
+        # the server restarted while the connection was idle
+        self.connections[0].down = True
+
+        with self.conn() as conn:
+            result = conn.search_s("o=gluu", ldap.SCOPE_BASE)
+        self.assertEqual(result[0][0], "o=gluu")
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].unbound)
+
+        # the new connection went back to the pool
+        with self.conn() as conn:
+            conn.search_s("o=gluu", ldap.SCOPE_BASE)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_checkout_leaves_the_other_connections_idle(self):
+        args = ("ldap.example.com", 1636, "cn=admin", "secret")
+        first = ldaplib.pool.get(*args)
+        second = ldaplib.pool.get(*args)
+        ldaplib.pool.put(first, *args)
+        ldaplib.pool.put(second, *args)
+
+        conn, reused = ldaplib.pool.checkout(*args)
+        self.assertTrue(reused)
+        key = ldaplib.pool._key("ldap.example.com", 1636, "cn=admin", False)
+        idle = [entry[0] for entry in ldaplib.pool._idle[key]]
+        self.assertEqual(len(idle), 1)
+        self.assertIsNot(idle[0], conn)
+        self.assertFalse(idle[0].unbound)
+
+    def test_idle_connections_are_checked_before_reuse(self):
+        ldaplib.pool.check_after = 0
+        with self.conn() as conn:
+            conn.search_s("o=gluu", ldap.SCOPE_BASE)
+        self.connections[0].down = True
+        with self.conn() as conn:
+            conn.search_s("o=gluu", ldap.SCOPE_BASE)
+        self.assertEqual(len(self.connections), 2)
+
+
+class SchemeCacheTest(StubbedLDAPTest):
+    def test_schemes_expire(self):
+        cache = SchemeCache(ttl=0.05)
+        cache.set("ldap.example.com", 1636, "ldaps")
+        self.assertEqual(cache.get("ldap.example.com", "1636"), "ldaps")
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("ldap.example.com", 1636))
+
+    def test_working_scheme_is_tried_first(self):
+        self.unreachable.add("ldap")
+        ldaplib._connect("ldap.example.com", 1636, "cn=admin", "secret")
+        self.assertEqual([c.uri for c in self.connections],
+                         ["ldap://ldap.example.com:1636",
+                          "ldaps://ldap.example.com:1636"])
+
+        ldaplib._connect("ldap.example.com", 1636, "cn=admin", "secret")
+        self.assertEqual(self.connections[-1].uri,
+                         "ldaps://ldap.example.com:1636")
+        self.assertEqual(len(self.connections), 3)
+
+
+class PagedConnection(object):
+    """Serves the entries in pages of the size asked by the paged results
+    control, like a server would.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.cookies = []
+        self.abandoned = []
+        self._pages = {}
+
+    def search_ext(self, base, scope, filterstr, attrlist, attrsonly,
+                   serverctrls):
+        ctrl = serverctrls[0]
+        self.cookies.append(ctrl.cookie)
+        offset = int(ctrl.cookie or 0)
+        msgid = len(self.cookies)
+        self._pages[msgid] = [offset, offset + ctrl.size]
+        return msgid
+
+    def result3(self, msgid, all=0):
+        offset, end = self._pages[msgid]
+        if offset < min(end, len(self.entries)):
+            self._pages[msgid][0] += 1
+            return ldap.RES_SEARCH_ENTRY, [self.entries[offset]], msgid, []
+        cookie = str(end) if end < len(self.entries) else ''
+        ctrl = SimplePagedResultsControl(True, size=0, cookie=cookie)
+        return ldap.RES_SEARCH_RESULT, [], msgid, [ctrl]
+
+    def abandon(self, msgid):
+        self.abandoned.append(msgid)
+
+
+class PagedSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.entries = [("uid=user{0},o=gluu".format(i), {})
+                        for i in range(5)]
+        self.conn = PagedConnection(self.entries)
+
+    def test_pages_are_requested_with_the_cookie(self):
+        found = list(paged_search(self.conn, "o=gluu", page_size=2))
+        self.assertEqual(found, self.entries)
+        self.assertEqual(self.conn.cookies, ['', '2', '4'])
+        self.assertEqual(self.conn.abandoned, [])
+
+    def test_unfinished_search_is_abandoned(self):
+        search = paged_search(self.conn, "o=gluu", page_size=2)
+        next(search)
+        search.close()
+        self.assertEqual(self.conn.abandoned, [1])
+
+
+class ParseCSNTest(unittest.TestCase):
+    def test_parse_csn(self):
+        timestamp, count, sid = parse_csn(
+            "20170718120000.123456Z#00000a#001#000000")
+        self.assertAlmostEqual(timestamp, 1500379200.123456)
+        self.assertEqual(count, 10)
+        self.assertEqual(sid, "001")
+
+    def test_parse_csn_without_fraction(self):
+        timestamp, count, sid = parse_csn("20170718120000Z#000000#002#000000")
+        self.assertEqual(timestamp, 1500379200)
+        self.assertEqual(sid, "002")
+
+
+if __name__ == '__main__':
+    unittest.main()
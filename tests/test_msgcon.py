@@ -0,0 +1,128 @@
+import time
+import unittest
+import urlparse
+
+from clustermgr.core import msgcon
+from clustermgr.core.msgcon import ResponseCache, LogCollection, \
+    get_audit_logs, keyset_supported
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_entries_expire(self):
+        cache = ResponseCache(ttl=0.05)
+        cache.set("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("key"))
+
+    def test_entries_can_have_their_own_ttl(self):
+        cache = ResponseCache(ttl=0.05)
+        cache.set("head", "newest logs")
+        cache.set("page", "older logs", ttl=60)
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("head"))
+        self.assertEqual(cache.get("page"), "older logs")
+
+    def test_entries_closest_to_expiry_are_dropped(self):
+        cache = ResponseCache(ttl=60, max_entries=2)
+        cache.set("first", 1)
+        cache.set("second", 2)
+        cache.set("third", 3)
+        self.assertIsNone(cache.get("first"))
+        self.assertEqual(cache.get("second"), 2)
+        self.assertEqual(cache.get("third"), 3)
+
+
+def response(ids):
+    return {"_embedded": {"logs": [
+        {"_links": {"self": {"href": "http://logger/logs/{0}".format(id)}}}
+        for id in ids]}}
+
+
+class LogCollectionTest(unittest.TestCase):
+    def test_first_page(self):
+        logs = LogCollection("logs", response([9, 8, 7]), size=3)
+        self.assertFalse(logs.has_prev)
+        self.assertEqual(logs.next_cursor, 7)
+
+    def test_last_page(self):
+        logs = LogCollection("logs", response([2, 1]), size=3, before=3)
+        self.assertFalse(logs.has_next)
+        self.assertEqual(logs.prev_cursor, 2)
+
+    def test_newer_page_is_reversed(self):
+        logs = LogCollection("logs", response([4, 5, 6]), size=3, after=3)
+        self.assertEqual([log.id for log in logs.get_logs()], [6, 5, 4])
+        self.assertEqual(logs.next_cursor, 4)
+        self.assertEqual(logs.prev_cursor, 6)
+
+    def test_newest_page_reached_going_back(self):
+        logs = LogCollection("logs", response([8, 9]), size=3, after=7)
+        self.assertFalse(logs.has_prev)
+        self.assertEqual(logs.next_cursor, 8)
+
+
+class Response(object):
+    ok = True
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class KeysetFallbackTest(unittest.TestCase):
+    """Runs get_audit_logs() against a logging server holding the logs 1 to
+    9, which may ignore the before and after arguments.
+    """
+
+    def setUp(self):
+        self.honors_cursors = False
+        self.urls = []
+        self._get = msgcon.session.get
+        msgcon.session.get = self.get
+        msgcon.cache.clear()
+        msgcon._offset_only.clear()
+
+    def tearDown(self):
+        msgcon.session.get = self._get
+        msgcon.cache.clear()
+        msgcon._offset_only.clear()
+
+    def get(self, url, timeout=None):
+        self.urls.append(url)
+        args = dict((k, v[0]) for k, v in urlparse.parse_qs(
+            urlparse.urlparse(url).query).items())
+        ids = range(9, 0, -1)
+        size = int(args["size"])
+        if self.honors_cursors and "before" in args:
+            ids = [id for id in ids if id < int(args["before"])]
+        page = int(args.get("page", 0))
+        return Response(response(ids[page * size:(page + 1) * size]))
+
+    def ids(self, data):
+        return [log.id for log in LogCollection("logs", data).get_logs()]
+
+    def test_cursor_is_used_when_honored(self):
+        self.honors_cursors = True
+        data, _ = get_audit_logs("http://logger", before=7, size=3, page=1)
+        self.assertEqual(self.ids(data), [6, 5, 4])
+        self.assertTrue(keyset_supported("http://logger"))
+        self.assertEqual(len(self.urls), 1)
+
+    def test_falls_back_to_page_numbers(self):
+        data, _ = get_audit_logs("http://logger", before=7, size=3, page=1)
+        self.assertEqual(self.ids(data), [6, 5, 4])
+        self.assertFalse(keyset_supported("http://logger"))
+        self.assertIn("page=1", self.urls[-1])
+
+        # the cursors are not tried again
+        data, _ = get_audit_logs("http://logger", before=4, size=3, page=2)
+        self.assertEqual(self.ids(data), [3, 2, 1])
+        self.assertEqual(len(self.urls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from clustermgr.core.timeseries import Series, Ring, downsample
+
+
+class RingTest(unittest.TestCase):
+    def test_oldest_points_are_overwritten(self):
+        ring = Ring(3)
+        for ts in range(5):
+            ring.add(ts, ts * 10)
+        self.assertEqual(ring.points(), [(2, 20), (3, 30), (4, 40)])
+
+    def test_values_are_averaged_per_period(self):
+        ring = Ring(10, 60)
+        ring.add(0, 1)
+        ring.add(30, 3)
+        ring.add(60, 10)
+        self.assertEqual(ring.points(), [(0, 2), (60, 10)])
+
+
+class SeriesTest(unittest.TestCase):
+    def setUp(self):
+        self.series = Series(((0, 10), (60, 10), (3600, 10)))
+        for ts in range(0, 7200, 30):
+            self.series.add(ts, 1.5)
+
+    def test_query_uses_the_finest_ring_covering_the_range(self):
+        resolution, points = self.series.query(7000, 7200)
+        self.assertEqual(resolution, 0)
+        self.assertEqual(len(points), 6)
+
+        resolution, points = self.series.query(6800, 7200)
+        self.assertEqual(resolution, 60)
+
+        resolution, points = self.series.query(0, 7200)
+        self.assertEqual(resolution, 3600)
+        self.assertEqual(points, [(0, 1.5), (3600, 1.5)])
+
+    def test_dumps_and_loads(self):
+        tiers = ((0, 10), (60, 10), (3600, 10))
+        copy = Series.loads(self.series.dumps(), tiers)
+        self.assertEqual(copy.query(0, 7200), self.series.query(0, 7200))
+        self.assertEqual(copy.query(7000, 7200),
+                         self.series.query(7000, 7200))
+
+    def test_loads_discards_data_of_other_tiers(self):
+        copy = Series.loads(self.series.dumps(), ((0, 5),))
+        self.assertEqual(copy.query(0, 7200), (0, []))
+
+
+class DownsampleTest(unittest.TestCase):
+    def test_downsample(self):
+        points = [(ts, ts) for ts in range(10)]
+        self.assertEqual(downsample(points, 0, 10, 2), [(2, 2), (7, 7)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import os
+import shutil
+import tempfile
 import unittest
 
-from clustermgr.utils import parse_slapdconf
+from clustermgr.core.utils import parse_slapdconf, sort_ldif, _sorted_lines
 
 
 class SlapdConfParseTest(unittest.TestCase):
@@ -21,3 +23,61 @@ class SlapdConfParseTest(unittest.TestCase):
                           "{SSHA}NtdgEfn/RjKonrJcvi2Qqn4qrk8ccedb")
         self.assertEquals(values["BCRYPT"], "{BCRYPT}")
 
+
+class SortLDIFTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parents_come_before_children(self):
+        current_dir = os.path.dirname(os.path.realpath(__file__))
+        src = os.path.join(current_dir, "data", "unsorted.ldif")
+        dst = os.path.join(self.tmpdir, "sorted.ldif")
+        stats = sort_ldif(src, dst)
+        self.assertEqual(stats["entries"], 4)
+        self.assertEqual(stats["errors"], [])
+        self.assertEqual(stats["orphans"], 1)
+
+        with open(dst) as f:
+            dns = [line.strip() for line in f if line.startswith("dn:")]
+        self.assertEqual(dns[:3], ["dn: o=gluu", "dn: ou=people,o=gluu",
+                                   "dn: uid=jdoe,ou=people,o=gluu"])
+
+    def test_orphans_are_found_by_their_exact_parent_dn(self):
+        src = os.path.join(self.tmpdir, "generated.ldif")
+        with open(src, "w") as f:
+            f.write("dn: o=gluu\nobjectClass: top\n\n")
+            f.write("dn: ou=people,o=gluu\nobjectClass: top\n\n")
+            for i in range(50):
+                f.write("dn: uid=user{0},ou=people,o=gluu\n"
+                        "objectClass: top\n\n".format(i))
+            for i in range(3):
+                f.write("dn: uid=user{0},ou=groups,o=gluu\n"
+                        "objectClass: top\n\n".format(i))
+        stats = sort_ldif(src, os.path.join(self.tmpdir, "sorted.ldif"))
+        self.assertEqual(stats["entries"], 55)
+        self.assertEqual(stats["orphans"], 3)
+
+    def test_last_record_without_final_newline(self):
+        src = os.path.join(self.tmpdir, "unterminated.ldif")
+        dst = os.path.join(self.tmpdir, "sorted.ldif")
+        with open(src, "w") as f:
+            f.write("dn: uid=x,ou=a,o=gluu\nobjectClass: top\n\n")
+            f.write("dn: ou=a,o=gluu\nobjectClass: top")
+        stats = sort_ldif(src, dst)
+        self.assertEqual(stats["entries"], 2)
+
+        with open(dst) as f:
+            self.assertEqual(f.read(),
+                             "dn: ou=a,o=gluu\nobjectClass: top\n\n"
+                             "dn: uid=x,ou=a,o=gluu\nobjectClass: top\n\n")
+
+    def test_lines_are_sorted_in_chunks(self):
+        path = os.path.join(self.tmpdir, "lines")
+        with open(path, "w") as f:
+            f.writelines("{0}\n".format(i) for i in [5, 3, 9, 1, 7, 3, 0])
+        self.assertEqual(list(_sorted_lines(path, self.tmpdir, 2)),
+                         ["0\n", "1\n", "3\n", "3\n", "5\n", "7\n",
+                          "9\n"])
@@ -0,0 +1,163 @@
+import unittest
+
+import redis
+
+from clustermgr.metrics import Metrics
+from clustermgr.weblogger import WebLogger, split_key
+
+
+class App(object):
+    name = "clustermgr.application"
+    config = {"REDIS_HOST": "localhost", "REDIS_PORT": 6379,
+              "REDIS_LOG_DB": 0}
+
+
+class SplitKeyTest(unittest.TestCase):
+    def test_task_keys(self):
+        self.assertEqual(split_key("app", "app:1234"), ("1234", "log"))
+        self.assertEqual(split_key("app", "app:1234:meta"), ("1234", "meta"))
+
+    def test_other_keys_are_ignored(self):
+        self.assertIsNone(split_key("app", "other"))
+        self.assertIsNone(split_key("app", "app:metrics:meta:x"))
+        self.assertIsNone(split_key("app", "app:1234:events"))
+        self.assertIsNone(split_key("app", "application:1234"))
+
+    def test_metric_keys_are_outside_the_log_keys(self):
+        app = App()
+        wlogger = WebLogger()
+        wlogger.init_app(app)
+        registry = Metrics(app)
+        for name in ("meta", "clustermgr_tasks_total"):
+            key = "{0}:{1}".format(registry.prefix, name)
+            self.assertIsNone(split_key(wlogger.prefix, key))
+            self.assertFalse(key.startswith(wlogger.prefix + ":"))
+
+
+class RedisApp(App):
+    name = "clustermgr.tests.weblogger"
+
+
+class WebLoggerRedisTest(unittest.TestCase):
+    """Runs WebLogger against the Redis server of the tests, the tests are
+    skipped when none is reachable.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        config = RedisApp.config
+        cls.redis = redis.Redis(host=config["REDIS_HOST"],
+                                port=config["REDIS_PORT"],
+                                db=config["REDIS_LOG_DB"])
+        try:
+            cls.redis.ping()
+        except redis.ConnectionError:
+            raise unittest.SkipTest("Redis is not reachable")
+
+    def setUp(self):
+        self.wlogger = WebLogger()
+        self.wlogger.init_app(RedisApp())
+        self.wlogger.max_entries = 5
+
+    def tearDown(self):
+        keys = list(self.redis.scan_iter(match=RedisApp.name + ":*"))
+        if keys:
+            self.redis.delete(*keys)
+
+    def log(self, first, last, level="info"):
+        for i in range(first, last):
+            self.wlogger.log("task", str(i), level)
+
+    def msgs(self, messages):
+        return [int(m["msg"]) for m in messages]
+
+    def test_oldest_messages_are_trimmed(self):
+        self.log(0, 8)
+        messages, cursor = self.wlogger.read("task")
+        self.assertEqual(self.msgs(messages), [3, 4, 5, 6, 7])
+        self.assertEqual(cursor, 8)
+
+    def test_log_is_trimmed_to_its_byte_limit(self):
+        self.wlogger.max_entries = 100
+        self.wlogger.max_bytes = 100
+        self.log(0, 20)
+        messages, cursor = self.wlogger.read("task")
+        self.assertEqual(self.msgs(messages), range(20 - len(messages), 20))
+        self.assertEqual(cursor, 20)
+        self.assertLessEqual(self.wlogger.stats()["bytes"], 100)
+        self.assertLess(len(messages), 20)
+
+    def test_last_message_is_kept_beyond_the_byte_limit(self):
+        self.wlogger.max_bytes = 10
+        self.wlogger.log("task", "a message longer than the limit")
+        messages, cursor = self.wlogger.read("task")
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(cursor, 1)
+
+    def test_read_from_cursor_after_trim(self):
+        self.log(0, 3)
+        messages, cursor = self.wlogger.read("task")
+        self.assertEqual(self.msgs(messages), [0, 1, 2])
+
+        # 3 more messages trim 0 and 1, the cursor still points at 3
+        self.log(3, 6)
+        messages, cursor = self.wlogger.read("task", cursor)
+        self.assertEqual(self.msgs(messages), [3, 4, 5])
+        self.assertEqual(cursor, 6)
+
+        self.log(6, 8)
+        messages, cursor = self.wlogger.read("task", cursor)
+        self.assertEqual(self.msgs(messages), [6, 7])
+        self.assertEqual(cursor, 8)
+
+        messages, cursor = self.wlogger.read("task", cursor)
+        self.assertEqual(messages, [])
+        self.assertEqual(cursor, 8)
+
+    def test_read_from_cursor_already_trimmed(self):
+        self.log(0, 2)
+        _, cursor = self.wlogger.read("task")
+        self.log(2, 12)
+        messages, cursor = self.wlogger.read("task", cursor)
+        self.assertEqual(self.msgs(messages), [7, 8, 9, 10, 11])
+        self.assertEqual(cursor, 12)
+
+    def test_buffered_messages_are_flushed_in_order(self):
+        self.wlogger.max_entries = 100
+        self.wlogger.buffer_size = 3
+        self.wlogger.flush_interval = 60
+        self.wlogger.start_buffering("task")
+        self.log(0, 4)
+        # the first 3 messages filled the buffer and were flushed
+        self.assertEqual(self.redis.llen(RedisApp.name + ":task"), 3)
+
+        # reading flushes the buffer
+        messages, cursor = self.wlogger.read("task")
+        self.assertEqual(self.msgs(messages), [0, 1, 2, 3])
+
+        self.log(4, 6)
+        self.wlogger.stop_buffering("task")
+        self.log(6, 7)
+        messages, cursor = self.wlogger.read("task", cursor)
+        self.assertEqual(self.msgs(messages), [4, 5, 6])
+
+    def test_summary_counts_the_trimmed_messages(self):
+        self.log(0, 4)
+        self.log(4, 6, "error")
+        self.log(6, 9, "debug")
+        summary = self.wlogger.get_summary("task")
+        self.assertEqual(summary["counts"],
+                         {"info": 4, "error": 2, "debug": 3})
+        self.assertEqual(summary["total"], 9)
+        self.assertEqual(summary["first_error"],
+                         {"msg": "4", "level": "error"})
+
+    def test_summary_without_error(self):
+        self.log(0, 2)
+        summary = self.wlogger.get_summary("task")
+        self.assertEqual(summary["counts"], {"info": 2})
+        self.assertIsNone(summary["first_error"])
+
+
+if __name__ == '__main__':
+    unittest.main()